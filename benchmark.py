@@ -0,0 +1,262 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+import matching
+
+
+# Syllables of Hausa and Yoruba style settlement names
+hausa_syllables = ["ba","da","dan","ga","gwa","ka","kau","ku","la","ma","mai","ra","ri","sa","shi",
+                   "ta","tsa","wa","ya","za","zu","bi","di","gi","ki","ru","yan","kwa","jib","ko"]
+yoruba_syllables = ["a","ba","de","fe","gun","i","ja","ko","la","mo","ni","o","ola","ke","ro",
+                    "sun","ta","wo","ye","yo","bo","da","fa","gbe","ile","ogbo","pe","ti","we","ro"]
+
+# Prefixes taken from common_words, with the variants the same prefix is captured as
+prefixes = {"anguwan ": ["anguwar ","unguwan ","angwa ",""], "unguwar ": ["unguwan ","anguwar ",""],
+            "gidan ": ["gida ","gildan ",""], "sabon gari ": ["sabongari ",""],
+            "mayo ": ["mayo-",""], "jauro ": ["jauro",""], "alhaji ": ["alh ",""]}
+
+# Each scenario is (LGAs, wards per LGA, P3B settlements per ward)
+scenarios = {
+    "ward": (1, 1, 60),
+    "lga": (1, 12, 60),
+    "state": (21, 12, 60),
+    "national": (774, 12, 60),
+}
+
+stages = ["get_p3b_list", "get_captured_list", "matching_same_name", "similar_name_0.9",
+          "similar_name_0.75", "create_excel"]
+
+def generate_name(rand):
+    """
+        Returns a random settlement name, with a common word prefix one time out of three.
+    """
+    syllables = hausa_syllables if rand.random() < 0.6 else yoruba_syllables
+    name = "".join(rand.choice(syllables) for _ in range(rand.randint(2, 4)))
+    if rand.random() < 0.15:
+        name += " " + "".join(rand.choice(syllables) for _ in range(2))
+    if rand.random() < 1 / 3:
+        name = rand.choice(list(prefixes)) + name
+    return name
+
+def misspell(rand, name):
+    """
+        Returns the name as a data collector could type it: up to two typos (substitution,
+        deletion, insertion or swap of letters), another form of its prefix and other casing
+        or punctuation.
+    """
+    for prefix, variants in prefixes.items():
+        if name.startswith(prefix) and rand.random() < 0.3:
+            name = rand.choice(variants) + name[len(prefix):]
+            break
+
+    letters = list(name)
+    for _ in range(rand.choice([0, 0, 1, 1, 2])):
+        i = rand.randrange(len(letters))
+        operation = rand.random()
+        if operation < 0.3:
+            letters[i] = rand.choice("aeioubdkgy")
+        elif operation < 0.55 and len(letters) > 3:
+            del letters[i]
+        elif operation < 0.8:
+            letters.insert(i, rand.choice("aeiouhw"))
+        elif i + 1 < len(letters):
+            letters[i], letters[i + 1] = letters[i + 1], letters[i]
+    name = "".join(letters).strip() or name
+
+    if rand.random() < 0.3:
+        name = name.title()
+    if rand.random() < 0.1:
+        name = name.replace(" ", "  ") + "."
+    return name
+
+def generate_state(seed, lgas, wards, settlements, captured=0.7, extra=0.3):
+    """
+        Generates the P3B sheets and a capture file of a state with a known answer.
+
+        Args:
+            seed (int): Seed of the random generator; the same seed gives the same data.
+            lgas (int): Number of LGAs.
+            wards (int): Number of wards in each LGA.
+            settlements (int): Number of P3B settlements in each ward.
+            captured (float, optional): Share of the P3B settlements that are captured, misspelt.
+                Defaults to 0.7.
+            extra (float, optional): Captures of settlements not in the P3B list, as a share of
+                the P3B settlements. Defaults to 0.3.
+
+        Returns:
+            tuple: The P3B DataFrame of each LGA, the capture DataFrame in the format of the
+                cleaned GRID3/RR Collect files, and the true matches as a dictionary of
+                (lga, ward, P3B name) to capture name, both cleaned as the matching does.
+    """
+    rand = random.Random(seed)
+    p3b = {}
+    captures = []
+    truth = {}
+    for l in range(lgas):
+        LGA = f"LGA {l}"
+        rows = []
+        for w in range(wards):
+            ward = f"Ward {w}"
+            names = set()
+            while len(names) < settlements:
+                names.add(generate_name(rand))
+
+            # Every capture of a ward must still be distinct once cleaned
+            taken = set()
+            latitude, longitude = rand.uniform(4, 13), rand.uniform(3, 14)
+            for name in sorted(names):
+                rows.append((name.upper() if rand.random() < 0.5 else name, ward))
+                if rand.random() < captured:
+                    capture = misspell(rand, name)
+                    key = clean(capture)
+                    if key not in taken and (key == name or key not in names):
+                        taken.add(key)
+                        truth[(LGA.lower(), ward.lower(), name)] = key
+                        captures.append((LGA, ward, capture, latitude + rand.gauss(0, 0.02), longitude + rand.gauss(0, 0.02)))
+            for _ in range(int(settlements * extra)):
+                capture = generate_name(rand)
+                if capture not in taken and capture not in names:
+                    taken.add(capture)
+                    captures.append((LGA, ward, capture, latitude + rand.gauss(0, 0.02), longitude + rand.gauss(0, 0.02)))
+        p3b[LGA] = pd.DataFrame(rows, columns=["List of contiguous communities/ settlements", "Wards"])
+
+    rand.shuffle(captures)
+    captures = pd.DataFrame(captures, columns=["LGA", "Ward", "Name of Settlement", "Latitude", "Longitude"])
+    return p3b, captures, truth
+
+def clean(name):
+    """
+        Cleans one name the way clean_names cleans a column.
+    """
+    return matching.clean_names(pd.Series([name])).iloc[0]
+
+def flatten_matches(perfect_match):
+    """
+        Returns the matches of a perfect match dictionary as a dictionary of (lga, ward, P3B name) to capture name.
+    """
+    found = {}
+    for lga, wards in perfect_match.items():
+        for ward, dhs in wards.items():
+            for settlement, captured in dhs.items():
+                for capture in captured:
+                    found[(lga, ward, settlement)] = capture
+    return found
+
+def get_quality(found, truth):
+    """
+        Compares the matches found to the true matches.
+
+        Args:
+            found (dict): The matches found (see flatten_matches).
+            truth (dict): The true matches (see generate_state).
+
+        Returns:
+            tuple: The precision and recall.
+    """
+    correct = sum(truth.get(key) == capture for key, capture in found.items())
+    precision = correct / len(found) if found else 1.0
+    recall = correct / len(truth) if truth else 1.0
+    return round(precision, 4), round(recall, 4)
+
+def run_scenario(name, seed=0, excel=True, scorer="difflib"):
+    """
+        Runs one scenario through the matching functions and measures each stage.
+
+        The stages are the steps of run() for one source: get_p3b_list and get_captured_list,
+        then for each LGA matching_same_name, similar_name at 0.9 and at 0.75 without common words,
+        and create_excel of the matches.
+
+        Args:
+            name (str): The scenario (see scenarios).
+            seed (int, optional): Seed of the generated data. Defaults to 0.
+            excel (bool, optional): Whether to run the create_excel stage. Defaults to True.
+            scorer (str, optional): The scorer of similar_name (see matching.scorers). Defaults to "difflib".
+
+        Returns:
+            list: One dictionary per stage with the wall time in seconds, the pairs scored,
+                the peak RSS of the process in MB after the stage and, for the matching stages,
+                the precision and recall of all the matches found up to the stage.
+    """
+    lgas, wards, settlements = scenarios[name]
+    p3b, captures, truth = generate_state(seed, lgas, wards, settlements)
+    results = {stage: {"scenario": name, "stage": stage, "seconds": 0.0, "pairs": 0, "max_rss_mb": None,
+                       "precision": None, "recall": None} for stage in stages}
+    found = {stage: {} for stage in stages}
+
+    def measure(stage, start, stats=None, perfect_match=None):
+        # Add the time and pairs of one call of a stage, and the matches found so far
+        results[stage]["seconds"] += time.perf_counter() - start
+        results[stage]["pairs"] += sum(stats.values()) if stats else 0
+        results[stage]["max_rss_mb"] = matching.get_peak_rss()
+        if perfect_match is not None:
+            found[stage].update(flatten_matches(perfect_match))
+
+    # Cached keys would make the later scenarios faster than the first one
+    matching.remove_common_words.cache_clear()
+
+    start = time.perf_counter()
+    p3b_lists = {LGA: matching.get_p3b_list(df, LGA)[0] for LGA, df in p3b.items()}
+    measure("get_p3b_list", start)
+
+    start = time.perf_counter()
+    store, coordinates = matching.get_captured_list(captures, grid3=True)
+    measure("get_captured_list", start)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "benchmark.xlsx")
+        for LGA, p3b_list in p3b_lists.items():
+            capture_list = matching.get_lga_captures(store, LGA)
+
+            start = time.perf_counter()
+            perfect_match = {}
+            p3b_list, capture_list, perfect_match, count = matching.matching_same_name(p3b_list, capture_list, perfect_match, LGA)
+            measure("matching_same_name", start, perfect_match=perfect_match)
+
+            for stage, ratio, dictionary in [("similar_name_0.9", .9, False), ("similar_name_0.75", .75, True)]:
+                stats = {}
+                start = time.perf_counter()
+                perfect_match, p3b_list, count, capture_list = matching.similar_name(p3b_list, capture_list, perfect_match, LGA, ratio, dictionary, stats=stats, scorer=scorer)
+                measure(stage, start, stats, perfect_match)
+
+            if excel:
+                start = time.perf_counter()
+                matching.create_excel(perfect_match, {}, LGA, file_name, True, coordinates=coordinates)
+                measure("create_excel", start)
+
+    for stage in ["matching_same_name", "similar_name_0.9", "similar_name_0.75"]:
+        results[stage]["precision"], results[stage]["recall"] = get_quality(found[stage], truth)
+    for result in results.values():
+        result["seconds"] = round(result["seconds"], 4)
+    return [result for stage, result in results.items() if excel or stage != "create_excel"]
+
+def print_results(results):
+    """
+        Prints the results of the scenarios as a table.
+    """
+    columns = ["scenario", "stage", "seconds", "pairs", "max_rss_mb", "precision", "recall"]
+    print(pd.DataFrame(results, columns=columns).to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the settlement matching on generated data.")
+    parser.add_argument("scenarios", nargs="*", default=["ward", "lga", "state"], choices=list(scenarios),
+                        help="Scenarios to run (default: ward lga state; national is run only when asked for)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated data")
+    parser.add_argument("--no-excel", action="store_true", help="Skip the create_excel stage")
+    parser.add_argument("--scorer", default="difflib", choices=list(matching.scorers), help="Scorer of similar_name")
+    parser.add_argument("--json", help="Also save the results to this JSON file")
+    args = parser.parse_args()
+
+    results = []
+    for scenario in args.scenarios:
+        results += run_scenario(scenario, args.seed, not args.no_excel, args.scorer)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=4)
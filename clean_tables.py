@@ -1,10 +1,12 @@
+import logging
+
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 rr_collect_filename = ''
 grid3_filename = ''
 state = ''
-df = pd.read_excel(rr_collect_filename,  index_col=None)
-df2 = pd.read_csv(grid3_filename, index_col=None)
 
 
 fields ={
@@ -22,59 +24,58 @@ fields ={
         "Date_time":"Form Filling End"
         }
 
-def write_csv(data_frame):
+# GRID3 columns used for matching and their names in the extracted files
+grid3_fields = {
+        "statename":"State",
+        "lganame":"LGA",
+        "wardname":"Ward",
+        "set_name":"Name of Settlement",
+        "Y":"Latitude",
+        "X":"Longitude",
+        }
+
+def write_csv(data_frame, log_level=logging.DEBUG):
     """
         a function that convert RR_Collect data to a format 
         suitable for matching process. It drops unwanted columns and splits 
-        the coordinates field. It creates two csv files one for settlements
-        and one for DH
+        the coordinates field into typed columns. It creates two csv files
+        one for settlements and one for DH
 
         Args:
                 Dataframe: pandas dataframe of the rr collect data set
+                log_level: logging level of the DH names and converted
+                           tables. Defaults to logging.DEBUG; the number of
+                           rows written is logged at INFO
         return:
                 None
 
     """
-    settlement_data = {"State":[],"LGA":[],"Ward":[], "Name of Settlement":[],"DH":[],
-                        "Latitude":[],"Longitude":[], "Acurracy":[], "Altitude":[],"Date_time":[]
-                    }
-    DH_data = {"State":[],"LGA":[],"Ward":[], "Settlement":[], "Name of DH":[], "Type of DH":[],
-                        "Latitude":[],"Longitude":[], "Acurracy":[], "Altitude":[],"Date_time":[]
-                    }
-    for idx in range(len(data_frame)):
-        if data_frame[fields["Type"]][idx] == "Distribution Hub":
-            print(data_frame[fields["Name of DH"]][idx])
-            DH_data["State"].append(data_frame[fields["State"]][idx])
-            DH_data["LGA"].append(data_frame[fields["LGA"]][idx])
-            DH_data["Ward"].append(data_frame[fields["Ward"]][idx])
-            DH_data["Settlement"].append(data_frame[fields["Settlement"]][idx])
-
-            DH_data["Name of DH"].append(data_frame[fields["Name of DH"]][idx])
-            type_of_dh = data_frame[fields["Type of DH"]][idx] if data_frame[fields["Type of DH"]][idx] != "Other" else data_frame[fields["Others"]][idx]
-            DH_data["Type of DH"].append(type_of_dh)
-            DH_data["Acurracy"].append(data_frame[fields["Location"]][idx].split("|")[0])
-            DH_data["Altitude"].append(data_frame[fields["Location"]][idx].split("|")[1])
-            DH_data["Latitude"].append(data_frame[fields["Location"]][idx].split("|")[2])
-            DH_data["Longitude"].append(data_frame[fields["Location"]][idx].split("|")[3])
-            DH_data["Date_time"].append(data_frame[fields["Date_time"]][idx])
-        else:
-            settlement_data["State"].append(data_frame[fields["State"]][idx])
-            settlement_data["LGA"].append(data_frame[fields["LGA"]][idx])
-            settlement_data["Ward"].append(data_frame[fields["Ward"]][idx])
-            settlement_data["Name of Settlement"].append(data_frame[fields["Name of Settlement"]][idx])
-            settlement_data["DH"].append(data_frame[fields["DH"]][idx])
-            settlement_data["Acurracy"].append(data_frame[fields["Location"]][idx].split("|")[0])
-            settlement_data["Altitude"].append(data_frame[fields["Location"]][idx].split("|")[1])
-            settlement_data["Latitude"].append(data_frame[fields["Location"]][idx].split("|")[2])
-            settlement_data["Longitude"].append(data_frame[fields["Location"]][idx].split("|")[3])
-            settlement_data["Date_time"].append(data_frame[fields["Date_time"]][idx])
-
-    settlement_dataframe = pd.DataFrame(settlement_data, index=None)
-    dh_dataframe = pd.DataFrame(DH_data, index=None)
-    print(settlement_dataframe)
-    print(dh_dataframe)
+    # Split the coordinates once: accuracy|altitude|latitude|longitude
+    location = data_frame[fields["Location"]].astype("string").str.split("|", expand=True).reindex(columns=range(4))
+    coordinates = {"Latitude": location[2], "Longitude": location[3], "Acurracy": location[0], "Altitude": location[1]}
+    coordinates = {column: pd.to_numeric(values, errors="coerce") for column, values in coordinates.items()}
+
+    # Route the submissions on the Type field
+    is_dh = data_frame[fields["Type"]] == "Distribution Hub"
+    type_of_dh = data_frame[fields["Type of DH"]].where(data_frame[fields["Type of DH"]] != "Other", data_frame[fields["Others"]])
+
+    settlement_dataframe = pd.DataFrame({
+        "State": data_frame[fields["State"]], "LGA": data_frame[fields["LGA"]], "Ward": data_frame[fields["Ward"]],
+        "Name of Settlement": data_frame[fields["Name of Settlement"]], "DH": data_frame[fields["DH"]],
+        **coordinates, "Date_time": data_frame[fields["Date_time"]],
+    })[~is_dh]
+    dh_dataframe = pd.DataFrame({
+        "State": data_frame[fields["State"]], "LGA": data_frame[fields["LGA"]], "Ward": data_frame[fields["Ward"]],
+        "Settlement": data_frame[fields["Settlement"]], "Name of DH": data_frame[fields["Name of DH"]],
+        "Type of DH": type_of_dh, **coordinates, "Date_time": data_frame[fields["Date_time"]],
+    })[is_dh]
+
+    logger.log(log_level, "DH names: %s", dh_dataframe["Name of DH"].tolist())
+    logger.log(log_level, "%s", settlement_dataframe)
+    logger.log(log_level, "%s", dh_dataframe)
     settlement_dataframe.to_csv("Cleaned_adamawa_settlement_capture.csv", index=False)
     dh_dataframe.to_csv("Cleaned_adamawa_DH_capture.csv", index=False)
+    logger.info("Wrote %d settlements and %d DHs", len(settlement_dataframe), len(dh_dataframe))
 
 def write_grid3_csv(data_frame,state):
     """
@@ -85,23 +86,49 @@ def write_grid3_csv(data_frame,state):
                             data 
                 state: The state you want it settlements to be extracted
     """
-    settlement_data = {"State":[],"LGA":[],"Ward":[], "Name of Settlement":[],
-                        "Latitude":[],"Longitude":[],}
-    for idx in range(len(data_frame)):
-        if data_frame['statename'][idx] == f"{state}":
-            settlement_data["State"].append(data_frame["statename"][idx])
-            settlement_data["LGA"].append(data_frame["lganame"][idx])
-            settlement_data["Ward"].append(data_frame["wardname"][idx])
-            settlement_data["Name of Settlement"].append(data_frame["set_name"][idx])
-            settlement_data["Latitude"].append(data_frame["Y"][idx])
-            settlement_data["Longitude"].append(data_frame["X"][idx])
-          
-
-    settlement_dataframe = pd.DataFrame(settlement_data, index=None)
-    print(settlement_dataframe)
+    # Keep the rows of the state and rename the columns for the matching process
+    settlement_dataframe = data_frame[data_frame["statename"] == f"{state}"][list(grid3_fields)].rename(columns=grid3_fields)
+    logger.debug("%s", settlement_dataframe)
     settlement_dataframe.to_csv(f"{state}_grid3_settlements.csv", index=False)
 
+def write_grid3_csvs(file_name, states=None, chunksize=100000):
+    """
+        extracts the settlement points of several states from the GRID3 csv
+        in one pass, reading it in chunks so the whole file is never in memory.
+        Only the needed columns are read, and each state is written to
+        its own "<state>_grid3_settlements.csv" as its rows are read
+        Args:
+                file_name: path of the GRID3 settlement point csv
+                states: The states you want extracted. Defaults to None,
+                        which extracts every state in the file
+                chunksize: number of rows read at a time
+        return:
+                dict: number of settlements written for each state
+    """
+    counts = {}
+    for chunk in pd.read_csv(file_name, usecols=list(grid3_fields), chunksize=chunksize):
+        # Filter on the state while reading
+        if states is not None:
+            chunk = chunk[chunk["statename"].isin(states)]
+        for state_name, rows in chunk.groupby("statename", sort=False):
+            # The first rows of a state replace any old file, the next ones are appended
+            rows[list(grid3_fields)].rename(columns=grid3_fields).to_csv(
+                f"{state_name}_grid3_settlements.csv", index=False,
+                mode="a" if state_name in counts else "w", header=state_name not in counts)
+            counts[state_name] = counts.get(state_name, 0) + len(rows)
+
+    # Requested states without any settlement still get an empty file
+    for state_name in states or []:
+        if state_name not in counts:
+            pd.DataFrame(columns=list(grid3_fields.values())).to_csv(f"{state_name}_grid3_settlements.csv", index=False)
+            counts[state_name] = 0
+    logger.info("Wrote the GRID3 settlements of each state: %s", counts)
+    return counts
+
 
-write_csv(df)
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    df = pd.read_excel(rr_collect_filename,  index_col=None)
+    write_csv(df)
 
-write_grid3_csv(df2,state)
\ No newline at end of file
+    write_grid3_csvs(grid3_filename, [state])
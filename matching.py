@@ -1,9 +1,38 @@
 import pandas as pd
+import numpy as np
 import openpyxl
 import re
-from copy import deepcopy
+from functools import lru_cache
 import difflib
+import heapq
 import os
+import hashlib
+import pickle
+import json
+import logging
+import time
+import cProfile
+import tracemalloc
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # Only needed by the rapidfuzz scorers
+    fuzz = process = None
+
+try:
+    import pyarrow
+except ImportError:  # Only needed by the Parquet report writer
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
 
 adamawa_LGA =  ["DEMSA","FUFORE","GANYE","GIREI","GOMBI","GUYUK","HONG","JADA",
                  "LAMURDE","MADAGALI","MAIHA","MAYO-BELWA","MICHIKA","MUBI NORTH",
@@ -16,6 +45,55 @@ osun_LGA = ["ATAKUNMOSA EAST","ATAKUNMOSA WEST","AYEDAADE","AYEDIRE","BOLUWADURO
         "IREPODUN","IREWOLE","ISOKAN","IWO","OBOKUN","ODO-OTIN","OLAOLUWA","OLORUNDA",
         "ORIADE","OROLU","OSHOGBO",]
 
+# Files read and written by run(); fill in before running
+grid3_filename = ""
+rr_collect_filename = ""
+p3b_filename = ""
+file_to_save_GRID3 = ""
+file_to_save_rr_collect = ""
+no_match_file = ""
+
+# Version of the files written by load_captured_list, bumped when their content changes
+cache_version = 1
+
+# Columns of the coordinates array returned by get_captured_list
+coordinate_columns = ["Latitude", "Longitude", "Accuracy", "Altitude"]
+
+# Common words removed from settlement names before matching when dictionary=True
+common_words = ["anguwan","anguwar","anguwa","angwa","ang","unguwan","unguwar",
+                "alhaji","alh", "gidan","gildan","jauro","ung"
+                "lccn","mayo", "village","head","phcc","phc","clinic","hc",
+                "health","clinic", "post", "hp","hc", "jauro",'gida',"h/c","h/p"
+                "house", "primary","pri", "school","sch","islamiyya","mallam","malam",
+                "primary", "secondary","hospital","dh","sec","line","street","str",
+                "sabon gari","sabongari"]
+common_words_pattern = re.compile("|".join(re.escape(word) for word in common_words))
+
+def clean_names(column):
+    """
+        Normalises a column of settlement names: lower case, dots and brackets removed
+        and runs of whitespace collapsed to a single space.
+
+        Args:
+            column (pandas.Series): The raw settlement names.
+
+        Returns:
+            pandas.Series: The normalised names.
+    """
+    return column.map(str).str.lower().str.replace(r"[.()]", "", regex=True).str.split().str.join(" ")
+
+def clean_column(column):
+    """
+        Converts a column to lower case stripped strings.
+
+        Args:
+            column (pandas.Series): The raw column.
+
+        Returns:
+            pandas.Series: The cleaned column.
+    """
+    return column.map(str).str.lower().str.strip()
+
 def get_p3b_list(df, LGA, p3b=True):
 
     """
@@ -29,46 +107,32 @@ def get_p3b_list(df, LGA, p3b=True):
         Returns:
         tuple: A tuple containing the extracted settlements (as a dictionary) and the number of settlements found.
      """
+    lga = f"{LGA}".lower().strip()
 
-    # Initialize an empty dictionary to store the extracted data
-    p3b_list = {}
+    # Keep the rows with a settlement name, taken from the appropriate column based on the p3b parameter
+    names = df[f"{'List of contiguous communities/ settlements' if p3b else 'P3B Name'}"].map(str)
+    rows = ~names.isin(["", " ", "NAN", "nan", "0"])
+    settlements = clean_names(names[rows])
+    wards = clean_column(df[f"{'Wards' if p3b else 'Ward'}"][rows])
 
-    # Initialize a counter variable to keep track of the number of settlements
-    count = 0
-   
-    # Iterate over each row of the DataFrame
-    for idx in range(len(df)):
-        # Extract the settlement information from the appropriate column based on the p3b parameter
-        if str(df[f"{'List of contiguous communities/ settlements' if p3b else 'P3B Name'}"][idx]) not in ["", " ", "NAN", "nan", "0"]:
-            settlement = " ".join(str(df[f"{'List of contiguous communities/ settlements' if p3b else 'P3B Name'}"][idx]).lower().replace(".", "").replace(".", "").replace(")", "").replace("(", "").strip().split())
-            
-            # Extract the LGA information from the input parameter
-            lga = f"{LGA}".lower().strip()
-
-            # Extract the ward information from the appropriate column based on the p3b parameter
-            ward = str(df[f"{'Wards' if p3b else 'Ward'}"][idx]).lower().strip()
-
-            # Add the settlement information to the p3b_list dictionary
-            if lga not in p3b_list:
-                p3b_list[lga] = {}
-            if ward not in p3b_list[lga]:
-                p3b_list[lga][ward] = set()
-            if settlement != "nan" and p3b and str(df["List of contiguous communities/ settlements"][idx]) not in ["", " ", "Nan", "NAN", "nan", "0", 0]:
-                p3b_list[lga][ward].add(settlement)
-                count += 1
-            elif not p3b and str(df["Geo Capture Name"][idx]) not in ["", " ", "Nan", "NAN", "nan", "0", 0]:
-                p3b_list[lga][ward].add(settlement)
-                count += 1
+    # Every ward with a named row gets an entry, but only valid settlements are added to it
+    if p3b:
+        added = (settlements != "nan") & ~names[rows].isin(["", " ", "Nan", "NAN", "nan", "0"])
+    else:
+        added = ~df["Geo Capture Name"][rows].map(str).isin(["", " ", "Nan", "NAN", "nan", "0"])
+
+    p3b_list = {lga: {ward: [] for ward in pd.unique(wards)}}
+    for ward, values in settlements[added].groupby(wards[added], sort=False):
+        # Sort the settlements in each ward by name
+        p3b_list[lga][ward] = sorted(set(values))
 
-    # Sort the settlements in each ward by name
-    for key, values in p3b_list[LGA.lower()].items():
-        count += len(values)
-        p3b_list[LGA.lower()][key] = sorted(values)
+    # Every added row is counted, then every distinct settlement again
+    count = int(added.sum()) + sum(len(values) for values in p3b_list[lga].values())
 
     # Return the p3b_list dictionary and the settlement count
     return p3b_list, count
 
-def get_captured_list(df, LGA, grid3=False):
+def get_captured_list(df, LGA=None, grid3=False):
 
     """
         Returns a dictionary of captured settlements in a given Local Government Area
@@ -77,49 +141,229 @@ def get_captured_list(df, LGA, grid3=False):
         Args:
         df (pandas DataFrame): The data containing settlement, LGA, ward, latitude, 
                                 longitude, and, if grid3 is False, altitude and accuracy.
-        LGA (str): The name of the Local Government Area.
+        LGA (str, optional): The name of the Local Government Area. Defaults to None,
+                                which returns every LGA of the file in one pass.
         grid3 (bool, optional): A boolean indicating whether to include altitude and accuracy 
                                 values in the output. Defaults to False. It salso indicates 
                                 whether the file is RR_colect or grid3 dataset
 
         Returns:
-        dict: A dictionary where keys are LGAs and values are dictionaries where keys are wards and values are dictionaries
-             where keys are settlements and values are strings of latitude and longitude separated by a '|' character, or, if grid3 is True, separated by '|' and followed by altitude and accuracy separated by '|'.
+        tuple: A dictionary where keys are LGAs and values are dictionaries where keys are wards and values are dictionaries
+             where keys are settlements and values are rows of the coordinates, and the coordinates: a float array with
+             one row per settlement and the columns of coordinate_columns. Accuracy and altitude are NaN if grid3 is True.
 
     """
+    # Get the name of the settlement, LGA, ward and coordinates of every row
+    captures = pd.DataFrame({
+        "lga": clean_column(df["LGA"]),
+        "ward": clean_column(df["Ward"]),
+        "settlement": clean_names(df["Name of Settlement"]),
+        "Latitude": pd.to_numeric(df["Latitude"], errors="coerce"),
+        "Longitude": pd.to_numeric(df["Longitude"], errors="coerce"),
+        "Accuracy": np.nan,
+        "Altitude": np.nan,
+    })
+
+    # If grid3 is False, also get the accuracy and altitude values
+    if not grid3:
+        captures["Accuracy"] = pd.to_numeric(df["Acurracy"], errors="coerce")
+        captures["Altitude"] = pd.to_numeric(df["Altitude"], errors="coerce")
+
+    # Keep the requested LGA and the first capture of each settlement in a ward
+    if LGA is not None:
+        captures = captures[captures["lga"] == LGA.lower()]
+    captures = captures.drop_duplicates(["lga", "ward", "settlement"]).reset_index(drop=True)
+    coordinates = captures[coordinate_columns].to_numpy(dtype=float)
+    captures["row"] = np.arange(len(captures))
+
     captured_list = {}
+    for (lga, ward), group in captures.groupby(["lga", "ward"], sort=False):
+        if lga not in captured_list:
+            captured_list[lga] = {}
+        captured_list[lga][ward] = dict(zip(group["settlement"], group["row"].tolist()))
+
+    return captured_list, coordinates
+
+def get_file_hash(file_name):
+    """
+        Returns the SHA-256 hash of the content of a file.
+
+        Args:
+            file_name (str): Path of the file.
+
+        Returns:
+            str: The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_captured_list(file_name, grid3=False, cache_dir=None):
+    """
+        Reads a GRID3 or RR Collect csv and returns its captured settlements for every LGA,
+        like get_captured_list(df, grid3=grid3).
+
+        If cache_dir is given, the result is saved there under the hash of the file content:
+        the dictionary as a pickle and the coordinates as a .npy array, which is memory-mapped
+        when reloaded. Later runs on the same file skip reading and normalising the csv.
 
-    # Iterate over each row in the dataframe
-    for idx in range(len(df)):
-        # Get the name of the settlement, LGA, ward, latitude, and longitude
-        settlement = " ".join(str(df["Name of Settlement"][idx]).lower().replace(".","").replace(".","").replace(")","").replace("(","").strip().split())
-        lga = str(df["LGA"][idx]).lower().strip()
-        ward = str(df["Ward"][idx]).lower().strip()
-        latitude= str(df["Latitude"][idx]).lower().strip()
-        longitude = str(df["Longitude"][idx]).lower().strip()
-
-        # If grid3 is False, also get the accuracy and altitude values
-        if not grid3:
-            accuracy = str(df["Acurracy"][idx]).lower().strip()
-            altitude = str(df["Altitude"][idx]).lower().strip()
-
-        # If the LGA matches the requested LGA
-        if lga == LGA.lower():
-            # Add the settlement to the captured_list dictionary
-            if lga not in captured_list:
-                captured_list[lga] = {}
-            if ward not in captured_list[lga]:
-                captured_list[lga][ward] = {}
-            if settlement not in captured_list[lga][ward]:
-                # If grid3 is False, only add latitude and longitude to the captured_list value
-                captured_list[lga][ward][settlement] = f"{latitude}|{longitude}" if grid3 else f"{latitude}|{longitude}|{accuracy}|{altitude}"
-
-    return captured_list
+        Args:
+            file_name (str): Path of the csv file.
+            grid3 (bool, optional): See get_captured_list. Defaults to False.
+            cache_dir (str, optional): Directory of the cache. Defaults to None (no cache).
+
+        Returns:
+            tuple: The captured settlements of every LGA and their coordinates.
+    """
+    if cache_dir is None:
+        return get_captured_list(pd.read_csv(file_name), grid3=grid3)
+
+    # The cache key changes with the file content, the grid3 flag and the cache format
+    key = f"{get_file_hash(file_name)}_{'grid3' if grid3 else 'full'}_v{cache_version}"
+    list_file = os.path.join(cache_dir, f"{key}.pkl")
+    coordinates_file = os.path.join(cache_dir, f"{key}.npy")
+    if os.path.isfile(list_file) and os.path.isfile(coordinates_file):
+        with open(list_file, "rb") as file:
+            captured_list = pickle.load(file)
+        return captured_list, np.load(coordinates_file, mmap_mode="r")
+
+    captured_list, coordinates = get_captured_list(pd.read_csv(file_name), grid3=grid3)
+
+    # Write to temporary files first so an interrupted run never leaves half a cache entry
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(f"{list_file}.tmp", "wb") as file:
+        pickle.dump(captured_list, file, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(f"{coordinates_file}.tmp", "wb") as file:
+        np.save(file, coordinates)
+    os.replace(f"{coordinates_file}.tmp", coordinates_file)
+    os.replace(f"{list_file}.tmp", list_file)
+    return captured_list, coordinates
+
+def load_p3b_sheets(file_name, LGAs, cache_dir=None):
+    """
+        Reads the P3B sheets of the given Local Government Areas (LGA), opening the workbook once.
+
+        The sheets are parsed one at a time as the generator is iterated, so matching can start on
+        the first LGA while the next sheets are read (see prefetch_items). If cache_dir is given, the
+        parsed sheets are saved there under the hash of the workbook content as a pickle of the
+        DataFrames, and later runs on the same workbook read them back without opening it.
+
+        Args:
+            file_name (str): Path of the P3B workbook, with one sheet per LGA named in upper case.
+            LGAs (list): The LGAs to read, in order.
+            cache_dir (str, optional): Directory of the cache. Defaults to None (no cache).
+
+        Yields:
+            tuple: The name of each LGA and its P3B sheet as a DataFrame.
+    """
+    sheets = {}
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"{get_file_hash(file_name)}_p3b_v{cache_version}.pkl")
+        if os.path.isfile(cache_file):
+            with open(cache_file, "rb") as file:
+                sheets = pickle.load(file)
+
+    missing = [LGA for LGA in LGAs if f"{LGA}".upper() not in sheets]
+    if not missing:
+        for LGA in LGAs:
+            yield LGA, sheets[f"{LGA}".upper()]
+        return
+
+    last = f"{missing[-1]}".upper()
+    with pd.ExcelFile(file_name, engine="openpyxl") as workbook:
+        for LGA in LGAs:
+            sheet_name = f"{LGA}".upper()
+            if sheet_name not in sheets:
+                sheets[sheet_name] = workbook.parse(sheet_name)
+
+                # Save the cache as soon as the last missing sheet is parsed, as the caller may
+                # stop iterating after the last LGA. Write to a temporary file first so an
+                # interrupted run never leaves half a cache entry
+                if sheet_name == last and cache_file is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    with open(f"{cache_file}.tmp", "wb") as file:
+                        pickle.dump(sheets, file, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(f"{cache_file}.tmp", cache_file)
+            yield LGA, sheets[sheet_name]
+
+def prefetch_items(items, size=2):
+    """
+        Iterates over items in a background thread, keeping up to size items ready ahead of the caller.
+
+        Args:
+            items (iterable): The items, e.g. the sheets of load_p3b_sheets.
+            size (int, optional): The number of items read ahead. Defaults to 2.
+
+        Yields:
+            The items in order. An error raised while reading them is raised here. When the caller
+            stops early or closes the generator, the thread stops reading and closes items.
+    """
+    ready = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(entry):
+        # Wait for room in the queue unless the caller stopped iterating
+        while not stop.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as error:
+            put((done, error))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    threading.Thread(target=read, daemon=True).start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def get_lga_captures(captured_store, LGA):
+    """
+        Returns the captured settlements of one LGA from a state-level store built by
+        get_captured_list(df) without an LGA, in the same format as get_captured_list(df, LGA).
+
+        The ward dictionaries are shared with the store, not copied, so the matching
+        functions that pop matched captures also consume them from the store.
+
+        Args:
+            captured_store (dict): The captured settlements of every LGA in the state.
+            LGA (str): The name of the Local Government Area.
+
+        Returns:
+            dict: A dictionary with the LGA as its only key, or an empty dictionary if the LGA has no captures.
+    """
+    lga = LGA.lower()
+    return {lga: captured_store[lga]} if lga in captured_store else {}
 
 def matching_same_name(p3b_list, capture_list, perfect_match, LGA, captured=True):
     """
         Matches settlements in the P3B list with those in the capture list that have the same name, 
         and returns a dictionary of perfect matches. 
+
+        Every LGA of the dictionaries is matched, so the whole state can be matched in one call.
         
         Args:
             p3b_list (dict): Dictionary of settlements in P3B list.
@@ -157,46 +401,434 @@ def matching_same_name(p3b_list, capture_list, perfect_match, LGA, captured=True
                             else:
                                 capture_list[lga][ward].remove(settlement)
                             
-                            # Add the settlement to the settlement list.
-                            if ward not in settlement_list:
-                                settlement_list[ward] = []
-                            settlement_list[ward].append(settlement)
+                            # Count the matches of the settlement in its ward.
+                            if (lga, ward) not in settlement_list:
+                                settlement_list[(lga, ward)] = {}
+                            settlement_list[(lga, ward)][settlement] = settlement_list[(lga, ward)].get(settlement, 0) + 1
     
-    # Remove settlements from the P3B list that have been matched using the settlement list.
-    for ward, settlements in settlement_list.items():
-        for settlement in settlements:
-            if settlement in p3b_list[LGA.lower()][ward]:
-                p3b_list[LGA.lower()][ward].remove(settlement)
+    # Remove settlements from the P3B list that have been matched in one pass over each ward:
+    # a settlement matched n times removes its first n occurrences, like list.remove.
+    for (lga, ward), settlements in settlement_list.items():
+        kept = []
+        for settlement in p3b_list[lga][ward]:
+            if settlements.get(settlement, 0):
+                settlements[settlement] -= 1
+            else:
+                kept.append(settlement)
+        p3b_list[lga][ward][:] = kept
     
     # Return the updated P3B list, capture list, perfect match dictionary, and count of matches.
     return p3b_list, capture_list, perfect_match, count
 
-def match_phrases(phrase1, phrase2, ratio=0.8):
+def match_phrases(phrase1, phrase2, ratio=0.8, best=None, stats=None, scores=None, floor=None):
     """
         Compares two phrases and returns whether they are a match based on a similarity ratio.
 
+        The full SequenceMatcher ratio is only computed for pairs that pass two cheaper upper
+        bounds: the length bound (difflib's real_quick_ratio) and quick_ratio. A pair whose bound
+        is below the ratio, or not above best, cannot be a match and is rejected early.
+
         Args:
             phrase1 (str): The first phrase to compare.
             phrase2 (str): The second phrase to compare.
             ratio (float, optional): The minimum similarity ratio required to consider the phrases a match. Defaults to 0.8.
+            best (float, optional): The best ratio found so far when only the maximum is needed.
+                Pairs that do not score above it are rejected. Defaults to None.
+            stats (dict, optional): Counts of the pairs eliminated by each tier ("real_quick_ratio",
+                "quick_ratio", "ratio"), of the pairs matched ("matched") and of the ratios taken
+                from scores ("cached"). Defaults to None.
+            scores (dict, optional): A score table of (phrase1, phrase2) to (value, exact), where value is
+                the exact ratio or, if exact is False, the quick_ratio bound. It is read and filled so
+                a pair is scored once however many passes compare it. Defaults to None.
+            floor (float, optional): The lowest ratio any pass using scores will ask for. Pairs whose bound or
+                ratio is below it can never match and are not stored, which keeps scores small.
+                Defaults to None, which uses ratio.
 
         Returns:
             tuple: A tuple containing a boolean indicating whether the phrases are a match, and the similarity ratio between them.
+                When a pair is rejected by a bound, the bound is returned instead of the ratio.
     """
     # If either phrase is empty or only contains whitespace, they cannot be a match
     if phrase1 in [" ",""] or phrase2 in [" ",""]:
         return False, 0
+
+    # Cheapest bound: the ratio can never exceed what the lengths of the two phrases allow
+    length = len(phrase1) + len(phrase2)
+    bound = 2.0 * min(len(phrase1), len(phrase2)) / length
+    if bound < ratio or (best is not None and bound <= best):
+        count_tier(stats, "real_quick_ratio")
+        return False, bound
+
+    # Reuse what an earlier pass stored about this pair: its exact ratio or its quick_ratio bound
+    floor = ratio if floor is None else floor
+    pair = (phrase1, phrase2)
+    cached = scores.get(pair) if scores is not None else None
+    if cached is not None and cached[1]:
+        count_tier(stats, "cached")
+        similarity_ratio = cached[0]
+    else:
+        # Next bound: the characters the two phrases have in common, ignoring their order
+        if cached is not None:
+            bound = cached[0]
+        else:
+            bound = difflib.SequenceMatcher(None, phrase1, phrase2).quick_ratio()
+            if scores is not None and bound >= floor:
+                scores[pair] = (bound, False)
+        if bound < ratio or (best is not None and bound <= best):
+            count_tier(stats, "quick_ratio")
+            return False, bound
+
+        # Calculate the similarity ratio between the two phrases using the SequenceMatcher class from difflib
+        similarity_ratio = difflib.SequenceMatcher(None, phrase1, phrase2).ratio()
+        if scores is not None and similarity_ratio >= floor:
+            scores[pair] = (similarity_ratio, True)
     
-    # Calculate the similarity ratio between the two phrases using the SequenceMatcher class from difflib
-    similarity_ratio = difflib.SequenceMatcher(None, phrase1, phrase2).ratio()
-    
-    # If the similarity ratio is above the specified threshold, consider the phrases a match
-    if similarity_ratio >= ratio:  
+    # If the similarity ratio is above the specified threshold (and the best so far), consider the phrases a match
+    if similarity_ratio >= ratio and (best is None or similarity_ratio > best):
+        count_tier(stats, "matched")
         return True, similarity_ratio
     else:
+        count_tier(stats, "ratio")
         return False, similarity_ratio
 
-def similar_name(p3b_list, capture_list, perfect_match, LGA, ratio, dictionary=False):
+def count_tier(stats, tier):
+    """
+        Increments the counter of a scoring tier if stats are being collected.
+
+        Args:
+            stats (dict or None): The counters, keyed by tier name.
+            tier (str): The tier to increment.
+    """
+    if stats is not None:
+        stats[tier] = stats.get(tier, 0) + 1
+
+def rapidfuzz_scores(query, choices, ratio, exact):
+    """
+        Scores one name against many with rapidfuzz's compiled Indel ratio, keeping the choices that reach the ratio.
+
+        The Indel ratio is 2 * (longest common subsequence) / (total length). difflib's ratio counts
+        the characters of its matching blocks, which are a common subsequence, so the Indel ratio
+        is never below it and a choice it rejects can never reach the ratio with difflib either.
+
+        Args:
+            query (str): The name to score.
+            choices (list): The names to score it against.
+            ratio (float): The minimum ratio to keep.
+            exact (bool): Whether the Indel ratio is used as the score (True) or only as a bound of difflib's ratio (False).
+
+        Returns:
+            dict: The (value, exact) of each index of choices that reaches the ratio (see match_phrases).
+    """
+    if process is None:
+        raise ImportError("The rapidfuzz scorers need the rapidfuzz package")
+    # A hair below the ratio, so that rounding never drops a pair sitting on the threshold
+    found = process.extract(query, choices, scorer=fuzz.ratio, processor=None, score_cutoff=ratio * 100 - 1e-6, limit=None)
+    return {index: (score / 100, exact) for choice, score, index in found}
+
+def rapidfuzz_bounds(query, choices, ratio):
+    """
+        Compatibility scorer: rapidfuzz prefilters the choices and difflib confirms the rest, so the matches are difflib's.
+    """
+    return rapidfuzz_scores(query, choices, ratio, False)
+
+def rapidfuzz_ratios(query, choices, ratio):
+    """
+        Fast scorer: rapidfuzz's Indel ratio is the score. It can be a little higher than difflib's ratio.
+    """
+    return rapidfuzz_scores(query, choices, ratio, True)
+
+# Scorers of the similar name passes. A scorer takes a name, a list of names and the ratio, and returns
+# the (value, exact) of the indexes that can reach the ratio; None leaves every pair to match_phrases
+scorers = {
+    "difflib": None,
+    "rapidfuzz": rapidfuzz_bounds,
+    "rapidfuzz-indel": rapidfuzz_ratios,
+}
+
+@lru_cache(maxsize=None)
+def remove_common_words(settlement):
+    """
+        Removes the common words (anguwan, gidan, primary, ...) from a settlement name.
+
+        The result is cached, so each name is stripped once per run. run() and update_run()
+        clear the cache when they start, so it only holds the names of one run. Names without
+        any common word are returned after a single search of common_words_pattern.
+
+        Args:
+            settlement (str): The settlement name.
+
+        Returns:
+            str: The settlement name with every common word removed.
+    """
+    if not common_words_pattern.search(settlement):
+        return settlement
+
+    # Remove the words one after the other, as removing one word can join the letters of another
+    for word in common_words:
+        settlement = settlement.replace(word, "")
+    return settlement
+
+def get_ngrams(settlement, n=3):
+    """
+        Returns the set of character n-grams of a settlement name padded with a space on each side.
+
+        Args:
+            settlement (str): The settlement name.
+            n (int, optional): The length of each gram. Defaults to 3.
+
+        Returns:
+            set: The n-grams of the name.
+    """
+    padded = f" {settlement} "
+    return {padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))}
+
+def build_ngram_index(settlements, n=3, key=None):
+    """
+        Builds a blocking index of n-gram postings over the settlements of a ward.
+
+        Args:
+            settlements (iterable): The settlement names to index.
+            n (int, optional): The length of each gram. Defaults to 3.
+            key (callable, optional): Applied to each name before extracting grams,
+                e.g. remove_common_words. Defaults to None.
+
+        Returns:
+            dict: A dictionary where keys are n-grams and values are sets of settlement names containing them.
+    """
+    index = {}
+    for settlement in settlements:
+        for gram in get_ngrams(key(settlement) if key else settlement, n):
+            if gram not in index:
+                index[gram] = set()
+            index[gram].add(settlement)
+    return index
+
+def get_candidates(index, settlement, top_k, n=3):
+    """
+        Looks up the settlements of an n-gram index sharing the most grams with a name.
+
+        Args:
+            index (dict): An index built by build_ngram_index.
+            settlement (str): The name to look up, already passed through the index key if any.
+            top_k (int): The maximum number of candidates to return.
+            n (int, optional): The length of each gram. Must match the index. Defaults to 3.
+
+        Returns:
+            set: The top_k settlements with the most shared grams, ties broken by name.
+    """
+    shared = {}
+    for gram in get_ngrams(settlement, n):
+        for candidate in index.get(gram, ()):
+            shared[candidate] = shared.get(candidate, 0) + 1
+    ranked = sorted(shared, key=lambda candidate: (-shared[candidate], candidate))
+    return set(ranked[:top_k])
+
+def blocking_recall(p3b_list, capture_list, LGA, ratio, top_k, dictionary=False):
+    """
+        Measures how many matches the blocking index loses compared to the exhaustive loop.
+
+        Every P3B/capture pair at or above the ratio is checked against the top_k candidates
+        of the P3B name, and similar_name is run both ways to compare the final matches.
+
+        Args:
+            p3b_list (dict): Dictionary of settlements in P3B list.
+            capture_list (dict): Dictionary of captured settlements.
+            LGA (str): Name of Local Government Area.
+            ratio (float): The similarity threshold.
+            top_k (int): Number of candidates kept by the index.
+            dictionary (bool, optional): Whether common words are removed. Defaults to False.
+
+        Returns:
+            dict: The number of pairs at or above the ratio, how many of them were kept as
+                candidates, the pair recall, and whether both runs produced the same matches.
+    """
+    key = remove_common_words if dictionary else (lambda settlement: settlement)
+    pairs = 0
+    kept = 0
+    for lga, wards in p3b_list.items():
+        if lga not in capture_list:
+            continue
+        for ward, settlements in wards.items():
+            if ward not in capture_list[lga]:
+                continue
+            index = build_ngram_index(capture_list[lga][ward], key=key)
+            for settlement in settlements:
+                candidates = get_candidates(index, key(settlement), top_k)
+                for settlement2 in capture_list[lga][ward]:
+                    if match_phrases(key(settlement), key(settlement2), ratio)[0]:
+                        pairs += 1
+                        kept += settlement2 in candidates
+
+    exhaustive = similar_name(p3b_list, capture_list, {}, LGA, ratio, dictionary)[0]
+    blocked = similar_name(p3b_list, capture_list, {}, LGA, ratio, dictionary, top_k=top_k)[0]
+    return {"pairs": pairs, "kept": kept, "recall": kept / pairs if pairs else 1.0,
+            "same_matches": exhaustive == blocked}
+
+class MatchState:
+    """
+        Tracks which P3B settlements and captured settlements the matching passes have consumed,
+        as sets of names per (LGA, ward), without copying or modifying the dictionaries.
+        Each pass works on what is left; get_p3b_list and get_capture_list build the
+        dictionaries without the matched settlements when they are needed.
+
+        Args:
+            p3b_list (dict): Dictionary of settlements in P3B list.
+            capture_list (dict): Dictionary of captured settlements.
+    """
+
+    def __init__(self, p3b_list, capture_list):
+        self.p3b_list = p3b_list
+        self.capture_list = capture_list
+        self.matched_p3b = {}
+        self.matched_captures = {}
+
+    def matched_captures_of(self, lga, ward):
+        """
+            Returns the set of matched captured settlements of a ward, which grows as matches are made.
+        """
+        if (lga, ward) not in self.matched_captures:
+            self.matched_captures[(lga, ward)] = set()
+        return self.matched_captures[(lga, ward)]
+
+    def remaining_p3b(self, lga, ward):
+        """
+            Returns the P3B settlements of a ward that are not matched yet, in order.
+        """
+        matched = self.matched_p3b.get((lga, ward), ())
+        return [settlement for settlement in self.p3b_list[lga][ward] if settlement not in matched]
+
+    def remaining_captures(self, lga, ward):
+        """
+            Returns the captured settlements of a ward that are not matched yet, in order.
+        """
+        matched = self.matched_captures.get((lga, ward), ())
+        return [settlement for settlement in self.capture_list[lga][ward] if settlement not in matched]
+
+    def consume(self, lga, ward, settlement, settlement2, capture_lga=None, capture_ward=None):
+        """
+            Marks a P3B settlement and the captured settlement it matched as matched.
+
+            Args:
+                lga (str): LGA of the P3B settlement.
+                ward (str): Ward of the P3B settlement.
+                settlement (str): The P3B settlement.
+                settlement2 (str): The captured settlement.
+                capture_lga (str, optional): LGA of the captured settlement, if not the same as the P3B one.
+                capture_ward (str, optional): Ward of the captured settlement, if not the same as the P3B one.
+
+            Returns:
+                The value of the captured settlement in the capture list (its coordinates row).
+        """
+        capture_lga = capture_lga or lga
+        capture_ward = capture_ward or ward
+        if (lga, ward) not in self.matched_p3b:
+            self.matched_p3b[(lga, ward)] = set()
+        self.matched_p3b[(lga, ward)].add(settlement)
+        self.matched_captures_of(capture_lga, capture_ward).add(settlement2)
+        return self.capture_list[capture_lga][capture_ward][settlement2]
+
+    def get_p3b_list(self):
+        """
+            Returns a new P3B dictionary without the matched settlements.
+        """
+        return {lga: {ward: self.remaining_p3b(lga, ward) for ward in wards} for lga, wards in self.p3b_list.items()}
+
+    def get_capture_list(self):
+        """
+            Returns a new capture dictionary without the matched settlements.
+        """
+        return {lga: {ward: {settlement2: settlements[settlement2] for settlement2 in self.remaining_captures(lga, ward)}
+                      for ward, settlements in wards.items()}
+                for lga, wards in self.capture_list.items()}
+
+def add_match(perfect_match, lga, ward, settlement, settlement2, value):
+    """
+        Adds a matched settlement to the perfect match dictionary.
+
+        Args:
+            perfect_match (dict): A dictionary to store the matching settlements.
+            lga (str): LGA of the P3B settlement.
+            ward (str): Ward of the P3B settlement.
+            settlement (str): The P3B settlement.
+            settlement2 (str): The captured settlement it matched.
+            value: The value of the captured settlement in the capture list.
+    """
+    if lga not in perfect_match:
+        perfect_match[lga] = {}
+    if ward not in perfect_match[lga]:
+        perfect_match[lga][ward] = {}
+    if settlement not in perfect_match[lga][ward]:
+        perfect_match[lga][ward][settlement] = {}
+    perfect_match[lga][ward][settlement][settlement2] = value
+
+def assign_settlements(scores):
+    """
+        Finds the one to one matching of P3B settlements to captures with the highest total ratio.
+
+        The sparse graph of scored pairs is solved as an assignment problem with successive shortest
+        augmenting paths (Dijkstra with potentials). Every settlement also gets a private "unmatched"
+        option, so only pairs in scores are ever matched and each search only visits the captures
+        connected to the settlement.
+
+        Args:
+            scores (list): One dictionary per P3B settlement of captured settlements to their ratio.
+
+        Returns:
+            list: The captured settlement assigned to each P3B settlement, or None if it stays unmatched.
+    """
+    # Number the captures; column len(columns) + i is the unmatched option of settlement i
+    columns = list(dict.fromkeys(settlement2 for matches in scores for settlement2 in matches))
+    column_ids = {settlement2: j for j, settlement2 in enumerate(columns)}
+    # Minimising 1 - ratio for matches and 1 for unmatched settlements maximises the total ratio
+    edges = [[(column_ids[settlement2], 1.0 - value) for settlement2, value in matches.items()] + [(len(columns) + i, 1.0)]
+             for i, matches in enumerate(scores)]
+
+    row_potential = [0.0] * len(scores)
+    column_potential = {}
+    column_row = {}
+    row_column = [None] * len(scores)
+
+    for start in range(len(scores)):
+        # Shortest path from the settlement to a free column over the reduced costs
+        distance = {}
+        previous = {}
+        done = {}
+        heap = []
+        row, row_distance = start, 0.0
+        while True:
+            for j, cost in edges[row]:
+                new_distance = row_distance + cost - row_potential[row] - column_potential.get(j, 0.0)
+                if j not in done and new_distance < distance.get(j, float("inf")):
+                    distance[j] = new_distance
+                    previous[j] = row
+                    heapq.heappush(heap, (new_distance, j))
+            while True:
+                column_distance, j = heapq.heappop(heap)
+                if j not in done and column_distance <= distance[j]:
+                    break
+            done[j] = column_distance
+            if j not in column_row:
+                break
+            row, row_distance = column_row[j], column_distance
+
+        # Update the potentials so the reduced costs stay non negative and the path is tight
+        for k, k_distance in done.items():
+            if k in column_row:
+                row_potential[column_row[k]] += column_distance - k_distance
+            column_potential[k] = column_potential.get(k, 0.0) - (column_distance - k_distance)
+        row_potential[start] += column_distance
+
+        # Flip the matches along the path
+        while True:
+            row = previous[j]
+            column_row[j] = row
+            row_column[row], j = j, row_column[row]
+            if row == start:
+                break
+
+    return [columns[j] if j < len(columns) else None for j in row_column]
+
+def similar_name(p3b_list, capture_list, perfect_match, LGA, ratio, dictionary=False, top_k=None, stats=None, assignment="greedy", scorer="difflib"):
     """
         Find similar names between two dictionaries of settlements.
 
@@ -216,6 +848,15 @@ def similar_name(p3b_list, capture_list, perfect_match, LGA, ratio, dictionary=F
             A boolean value that specifies if the settlement name should be captured or not.
         dictionary : bool, optional
             A boolean value that specifies if the common words in the settlement names should be removed.
+        top_k : int, optional
+            If given, only the top_k captures sharing the most trigrams with a P3B name are scored
+            (see build_ngram_index). Defaults to None, which scores every capture in the ward.
+        stats : dict, optional
+            Counts of the pairs eliminated by each scoring tier (see match_phrases).
+        assignment : str, optional
+            "greedy" (default) or "optimal" one to one matching of each ward (see match_similar).
+        scorer : str, optional
+            "difflib" (default), "rapidfuzz" or "rapidfuzz-indel" (see scorers and match_similar).
 
         Returns:
         --------
@@ -226,162 +867,962 @@ def similar_name(p3b_list, capture_list, perfect_match, LGA, ratio, dictionary=F
             - The number of settlements removed.
             - A dictionary of settlements that did not match.
     """
-    p3b_list=deepcopy(p3b_list)  # Make a copy of p3b_list to avoid modifying the original
-    capture_list=deepcopy(capture_list)  # Make a copy of capture_list to avoid modifying the original
+    state = MatchState(p3b_list, capture_list)  # Track the matches without modifying the originals
+    count = match_similar(state, perfect_match, ratio, dictionary, top_k, stats, assignment, scorer=scorer)
+
+    # return the following variables
+    return perfect_match, state.get_p3b_list(), count, state.get_capture_list()
+
+def match_similar(state, perfect_match, ratio, dictionary=False, top_k=None, stats=None, assignment="greedy", scores=None, scorer="difflib", floor=None):
+    """
+        Runs one similar_name pass over the settlements of a MatchState that are not matched yet.
+
+        Args:
+            state (MatchState): The P3B and captured settlements, and the ones already matched.
+            perfect_match (dict): A dictionary to store the matching settlements.
+            ratio (float): The minimum similarity ratio between the settlement names.
+            dictionary (bool, optional): Whether the common words in the settlement names are removed. Defaults to False.
+            top_k (int, optional): Number of candidates kept by the blocking index (see similar_name). Defaults to None.
+            stats (dict, optional): Counts of the pairs eliminated by each scoring tier, with "scorer" for
+                the pairs dropped by the scorer. Defaults to None.
+            assignment (str, optional): "greedy" gives each P3B settlement, in order, its best remaining capture.
+                "optimal" matches the settlements and captures of each ward one to one with the highest
+                total ratio (see assign_settlements). Defaults to "greedy".
+            scores (dict, optional): The score tables of each (LGA, ward), kept between passes so that
+                a pair is only scored once (see match_phrases). Defaults to None.
+            scorer (str, optional): The scorer that scores each P3B settlement against all the captures
+                of its ward in one call before match_phrases (see scorers). "difflib" scores every pair
+                with match_phrases alone. "rapidfuzz" drops the captures that cannot reach the ratio and
+                gives match_phrases a tighter bound for the rest, so the matches stay the same.
+                "rapidfuzz-indel" uses rapidfuzz's ratio as the score. Defaults to "difflib".
+            floor (float, optional): The lowest ratio of the passes sharing scores (see match_phrases).
+                Defaults to None, which uses ratio.
+
+        Returns:
+            int: The number of settlements matched.
+    """
     count =0  # Initialize a count variable to zero
-    settlement_list = {}  # Create an empty dictionary to store the settlement data
+    score_batch = scorers[scorer]
 
     # Loop through the LGA and wards in p3b_list
-    for lga, wards in p3b_list.items():
-        if lga in capture_list:  # Check if the LGA is in the capture_list or matching
+    for lga, wards in state.p3b_list.items():
+        if lga in state.capture_list:  # Check if the LGA is in the capture_list or matching
             # Loop through the wards in the p3b_list
             for ward in wards:
-                if ward in capture_list[lga]:  # Check if the ward is in the capture_list for the current LGA
-                    # Loop through the settlements in the current ward
-                    for settlement in wards[ward]:
+                if ward in state.capture_list[lga]:  # Check if the ward is in the capture_list for the current LGA
+                    matched = state.matched_captures_of(lga, ward)  # captures consumed by earlier matches
+                    table = None  # score table of the ward, shared by every pass over it
+                    if scores is not None:
+                        if (lga, ward) not in scores:
+                            scores[(lga, ward)] = {}
+                        table = scores[(lga, ward)]
+                    elif score_batch is not None:
+                        table = {}  # the batch scores reach match_phrases through the table
+
+                    # Compute the key of every remaining capture of the ward once, with common words removed if dictionary is true
+                    capture_keys = {settlement2: remove_common_words(settlement2) if dictionary else settlement2
+                                    for settlement2 in state.remaining_captures(lga, ward)}
+
+                    # Build the blocking index of the ward once; matched captures are removed from it
+                    index = None
+                    if top_k is not None:
+                        index = build_ngram_index(capture_keys, key=capture_keys.get)
+                    choices = list(capture_keys.values())
+
+                    # Score the settlements of the current ward against the remaining captures
+                    settlements = state.remaining_p3b(lga, ward)
+                    ward_scores = []
+                    for settlement in settlements:
                         matcthin_list = {}  # Initialize an empty dictionary to store matching settlements
+                        best = None  # Best ratio found so far for the current settlement
+                        settlement_remove = remove_common_words(settlement) if dictionary else settlement  # key of the current settlement
+                        candidates = None
+                        if index is not None: # only the top_k candidates from the index reach the ratio
+                            candidates = get_candidates(index, settlement_remove, top_k)
+                        batch = None
+                        if score_batch is not None: # only the captures the scorer keeps reach match_phrases
+                            batch = score_batch(settlement_remove, choices, ratio)
 
                         # Loop through the settlements in the capture_list for the current LGA and ward
-                        for settlement2 in capture_list[lga][ward]:
-                            common_words = ["anguwan","anguwar","anguwa","angwa","ang","unguwan","unguwar",
-                                            "alhaji","alh", "gidan","gildan","jauro","ung"
-                                            "lccn","mayo", "village","head","phcc","phc","clinic","hc",
-                                            "health","clinic", "post", "hp","hc", "jauro",'gida',"h/c","h/p"
-                                            "house", "primary","pri", "school","sch","islamiyya","mallam","malam",
-                                            "primary", "secondary","hospital","dh","sec","line","street","str",
-                                            "sabon gari","sabongari"]  # Define a list of common words to remove from settlement names
-                            
-                            settlement_remove = settlement  # Set the settlement_remove variable to the current settlement
-                            settlement2_remove = settlement2  # Set the settlement2_remove variable to the current settlement in the capture_list
-                            if dictionary: # if dictionary is true remove common words
-                                for word in common_words: # loop through common_words list
-                                    settlement_remove = settlement_remove.replace(word,"") # remove common words from settlement
-                                    settlement2_remove = settlement2_remove.replace(word,"") # remove common words from settlement2
-                            settlement2_remove.strip() # remove leading/trailing spaces from settlement2_remove
-                            settlement_remove.strip() # remove leading/trailing spaces from settlement_remove
-                            get_match = match_phrases(settlement_remove,settlement2_remove,ratio) # get match between settlement and settlement2
+                        for position, (settlement2, settlement2_remove) in enumerate(capture_keys.items()):
+                            if settlement2 in matched or (candidates is not None and settlement2 not in candidates):
+                                continue
+                            if batch is not None:
+                                if position not in batch:
+                                    count_tier(stats, "scorer")
+                                    continue
+                                # Store the batch score unless the table already has the exact ratio
+                                pair = (settlement_remove, settlement2_remove)
+                                if pair not in table or not table[pair][1]:
+                                    table[pair] = batch[position]
+                            get_match = match_phrases(settlement_remove,settlement2_remove,ratio,best,stats,table,floor) # get match between settlement and settlement2
                             if get_match[0]: # if get_match is is true
                                 matcthin_list[settlement2] = get_match[1] # add settlement2 and its match ratio to matcthin_list
-                        if matcthin_list: # if matcthin_list is not empty
+                                if assignment == "greedy":
+                                    best = get_match[1] # later captures must beat it to become the best match
+
+                        if assignment == "optimal":
+                            # Keep every capture above the ratio for the assignment of the whole ward
+                            ward_scores.append(matcthin_list)
+                        elif matcthin_list: # if matcthin_list is not empty
                             settlement2 = max(matcthin_list, key=matcthin_list.get) # get settlement2 with highest match ratio
-                            if lga not in perfect_match: # if lga not in perfect_match
-                                perfect_match[lga]={} # add lga to perfect_match
-                            if ward not in perfect_match[lga]: # if ward not in perfect_match[lga]
-                                perfect_match[lga][ward]={} # add ward to perfect_match[lga]
-                            if settlement not in perfect_match[lga][ward]: # if settlement not in perfect_match[lga][ward]
-                                perfect_match[lga][ward][settlement]={} # add settlement to perfect_match[lga][ward]
-                            perfect_match[lga][ward][settlement][settlement2]=capture_list[lga][ward][settlement2] 
-                            # add settlement and its best match (settlement2) to perfect_match[lga][ward]
-                            capture_list[lga][ward].pop(settlement2) # remove settlement2 from capture_list
-                            if ward not in settlement_list: # if ward not in settlement_list
-                                settlement_list[ward] =set() # add ward to settlement_list
-                            settlement_list[ward].add(settlement) # add settlement to settlement_list[ward]
-
-    # loop through settlement_list to remove settlements that are matched in p3b_list
-    for ward, settlements in settlement_list.items(): # loop through settlement_list
-        for settlement in settlements: # loop through settlements in ward
-            if settlement in p3b_list[LGA.lower()][ward]: # if settlement is in p3b_list[LGA.lower()][ward]
-                p3b_list[LGA.lower()][ward].remove(settlement) # remove settlement from p3b_list
-            count+=1
+                            # add settlement and its best match (settlement2) to perfect_match and mark both as matched
+                            add_match(perfect_match, lga, ward, settlement, settlement2, state.consume(lga, ward, settlement, settlement2))
+                            count+=1
+                            # A matched capture is no longer a candidate
+                            if index is not None:
+                                for gram in get_ngrams(capture_keys[settlement2]):
+                                    index[gram].discard(settlement2)
 
-    # return the following variables
-    return perfect_match, p3b_list, count, capture_list
+                    # Match the settlements and captures of the ward one to one with the highest total ratio
+                    if assignment == "optimal":
+                        for settlement, settlement2 in zip(settlements, assign_settlements(ward_scores)):
+                            if settlement2 is not None:
+                                add_match(perfect_match, lga, ward, settlement, settlement2, state.consume(lga, ward, settlement, settlement2))
+                                count+=1
+
+    return count
 
-def create_excel(matched_settlements, unmatched_settlements,LGA, file_name, grid3=False,field_name="GRID3 Name"):
+def cascade_match(state, perfect_match, tiers, scores, assignment="greedy", stages=None, stage=None, LGA=None, scorer="difflib", floor=None, top_k=None):
     """
-        Creates an excel sheet with settlement data for a given Local Government Area (LGA).
+        Runs several similar name passes over a MatchState, one per tier, from one score table.
+
+        A pair's raw and dictionary ratios are computed the first time a tier needs them and
+        read back from scores by the following tiers, including later cascades given the same
+        scores, so the tiers resolve in the same order as separate passes but score each pair once.
+
+        Args:
+            state (MatchState): The P3B and captured settlements, and the ones already matched.
+            perfect_match (dict): A dictionary to store the matching settlements.
+            tiers (list): (ratio, dictionary) of each pass, in order, e.g. [(.9, False), (.75, True)].
+            scores (dict): The score tables of each (LGA, ward) (see match_similar).
+            assignment (str, optional): "greedy" or "optimal" (see match_similar). Defaults to "greedy".
+            stages (list, optional): If given, each tier is recorded in it as "<stage> <ratio>" of LGA
+                (see record_stage). Defaults to None.
+            stage (str, optional): Name of the cascade in stages, e.g. "grid3 similar". Defaults to None.
+            LGA (str, optional): Name of the Local Government Area (LGA) in stages. Defaults to None.
+            scorer (str, optional): See match_similar. Defaults to "difflib".
+            floor (float, optional): The lowest ratio of every cascade given the same scores; pairs below it
+                are not stored (see match_phrases). Defaults to None, which uses the lowest ratio of tiers.
+            top_k (int, optional): Number of candidates kept by the blocking index of each tier
+                (see similar_name). Defaults to None, which scores every pair.
+
+        Returns:
+            list: The number of settlements matched by each tier.
+    """
+    if floor is None:
+        floor = min(ratio for ratio, dictionary in tiers)
+    counts = []
+    for ratio, dictionary in tiers:
+        start = start_stage()
+        stats = {} if stages is not None else None
+        counts.append(match_similar(state, perfect_match, ratio, dictionary, top_k, stats, assignment, scores, scorer, floor))
+        record_stage(stages, LGA, f"{stage} {ratio}", start, stats, counts[-1])
+    return counts
+
+def get_peak_rss():
+    """
+        Returns the peak resident set size of the process in MB since it started, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if os.uname().sysname == "Darwin" else 1024), 1)
+
+def start_stage():
+    """
+        Returns the wall and CPU clocks at the start of a stage, and the memory traced by tracemalloc
+        if it is tracing (see record_stage). The traced peak is reset so that it belongs to the stage.
+    """
+    memory = None
+    if tracemalloc.is_tracing():
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    return time.perf_counter(), time.process_time(), memory
+
+def record_stage(stages, LGA, stage, start, stats=None, matches=0):
+    """
+        Records the wall and CPU time of a stage since start, with the pairs it compared,
+        the settlements it matched and its memory use: "memory_mb" is the peak memory traced
+        during the stage above what was traced at its start (None unless tracemalloc is tracing),
+        and "max_rss_mb" the peak resident set size of the process so far, which covers every
+        stage before it as well.
+
+        Args:
+            stages (list or None): The records of the run. Nothing is recorded if None.
+            LGA (str): Name of the Local Government Area (LGA), or "state" for a stage of the whole run.
+            stage (str): Name of the stage, e.g. "grid3 exact".
+            start (tuple): The clocks returned by start_stage.
+            stats (dict, optional): The scoring tier counts of the stage (see match_phrases);
+                their sum is the number of pairs compared. Defaults to None.
+            matches (int, optional): Number of settlements matched. Defaults to 0.
+    """
+    if stages is None:
+        return
+    wall, cpu, memory = start
+    if memory is not None and tracemalloc.is_tracing():
+        memory = round((tracemalloc.get_traced_memory()[1] - memory) / (1024 * 1024), 3)
+    else:
+        memory = None
+    stages.append({"lga": LGA, "stage": stage, "wall_seconds": round(time.perf_counter() - wall, 6),
+                   "cpu_seconds": round(time.process_time() - cpu, 6), "pairs": sum(stats.values()) if stats else 0,
+                   "matches": matches, "memory_mb": memory, "max_rss_mb": get_peak_rss()})
+
+def write_run_report(stages, file_name):
+    """
+        Writes the stage records of a run to a CSV file if file_name ends with ".csv", and to a JSON file otherwise.
+
+        Args:
+            stages (list): The records of the run (see record_stage).
+            file_name (str): The file to write.
+    """
+    if file_name.lower().endswith(".csv"):
+        pd.DataFrame(stages, columns=["lga", "stage", "wall_seconds", "cpu_seconds", "pairs", "matches", "memory_mb", "max_rss_mb"]).to_csv(file_name, index=False)
+    else:
+        with open(file_name, "w") as file:
+            json.dump(stages, file, indent=4)
+
+def get_p3b_points(df, LGA, p3b=True):
+    """
+        Extracts the coordinates of the P3B settlements that have them.
+
+        Args:
+            df (pandas.DataFrame): The DataFrame containing the P3B information, with Latitude and Longitude columns.
+            LGA (str): The name of the Local Government Area (LGA).
+            p3b (bool): Indicates whether the Dataframe is a P3B or not.
+
+        Returns:
+            dict: A dictionary where keys are LGAs and values are dictionaries where keys are wards and values
+                  are dictionaries of settlements to (latitude, longitude). Empty if the sheet has no coordinates.
+    """
+    p3b_points = {}
+    if "Latitude" not in df or "Longitude" not in df:
+        return p3b_points
+
+    points = pd.DataFrame({
+        "ward": clean_column(df[f"{'Wards' if p3b else 'Ward'}"]),
+        "settlement": clean_names(df[f"{'List of contiguous communities/ settlements' if p3b else 'P3B Name'}"]),
+        "Latitude": pd.to_numeric(df["Latitude"], errors="coerce"),
+        "Longitude": pd.to_numeric(df["Longitude"], errors="coerce"),
+    }).dropna(subset=["Latitude", "Longitude"]).drop_duplicates(["ward", "settlement"])
+
+    lga = f"{LGA}".lower().strip()
+    p3b_points[lga] = {}
+    for ward, group in points.groupby("ward", sort=False):
+        p3b_points[lga][ward] = dict(zip(group["settlement"], zip(group["Latitude"], group["Longitude"])))
+    return p3b_points
+
+def build_spatial_index(coordinates, rows, cell_size=0.01):
+    """
+        Builds a grid-bucket index over the latitude and longitude of captured settlements.
+
+        Args:
+            coordinates (numpy.ndarray): The coordinates returned by get_captured_list.
+            rows (iterable): The rows of the coordinates to index.
+            cell_size (float, optional): The size of a grid cell in degrees. Defaults to 0.01 (about 1.1 km).
+
+        Returns:
+            dict: A dictionary where keys are (latitude cell, longitude cell) and values are lists of rows.
+    """
+    rows = np.fromiter(rows, dtype=int)
+    rows = rows[~np.isnan(coordinates[rows, :2]).any(axis=1)]
+    cells = np.floor(coordinates[rows, :2] / cell_size).astype(int)
+
+    spatial_index = {}
+    for row, cell in zip(rows.tolist(), map(tuple, cells.tolist())):
+        if cell not in spatial_index:
+            spatial_index[cell] = []
+        spatial_index[cell].append(row)
+    return spatial_index
+
+def get_nearby_rows(spatial_index, coordinates, latitude, longitude, radius, cell_size=0.01):
+    """
+        Finds the captured settlements within a radius of a point.
+
+        Args:
+            spatial_index (dict): An index built by build_spatial_index.
+            coordinates (numpy.ndarray): The coordinates the index was built from.
+            latitude (float): Latitude of the point.
+            longitude (float): Longitude of the point.
+            radius (float): The search radius in kilometres.
+            cell_size (float, optional): The cell size of the index. Defaults to 0.01.
+
+        Returns:
+            list: The rows within the radius, in row order.
+    """
+    # Visit every cell overlapping the bounding box of the radius
+    lat_cells = int(np.ceil(radius / 111.32 / cell_size))
+    lon_cells = int(np.ceil(radius / (111.32 * max(np.cos(np.radians(latitude)), 0.01)) / cell_size))
+    lat_cell = int(np.floor(latitude / cell_size))
+    lon_cell = int(np.floor(longitude / cell_size))
+    rows = []
+    for i in range(lat_cell - lat_cells, lat_cell + lat_cells + 1):
+        for j in range(lon_cell - lon_cells, lon_cell + lon_cells + 1):
+            rows.extend(spatial_index.get((i, j), ()))
+    if not rows:
+        return []
+
+    # Keep the rows whose haversine distance is within the radius
+    rows = np.array(sorted(rows))
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(coordinates[rows, 0]), np.radians(coordinates[rows, 1])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    distance = 2 * 6371.0 * np.arcsin(np.sqrt(a))
+    return rows[distance <= radius].tolist()
+
+def nearby_name(p3b_list, p3b_points, capture_list, coordinates, perfect_match, LGA, ratio, radius=2.0, dictionary=False):
+    """
+        Find similar names between P3B settlements with coordinates and the captured settlements
+        within a radius of them, whatever ward the capture was filed under.
+
+        P3B settlements without coordinates are left for similar_name.
+
+        Parameters:
+        -----------
+        p3b_list : dict
+            A dictionary of settlements with Local Government Areas and wards as keys from P3B.
+        p3b_points : dict
+            The coordinates of the P3B settlements (see get_p3b_points).
+        capture_list : dict
+            A dictionary of settlements with Local Government Areas and wards as keys from RR Collect of GRID3.
+        coordinates : numpy.ndarray
+            The coordinates of the captured settlements (see get_captured_list).
+        perfect_match : dict
+            A dictionary to store the matching settlements.
+        LGA : str
+            A string that specifies the Local Government Area to match.
+        ratio : float
+            A float between 0 and 1 that specifies the ratio of similarity between the settlement names.
+        radius : float, optional
+            The search radius in kilometres. Defaults to 2.0.
+        dictionary : bool, optional
+            A boolean value that specifies if the common words in the settlement names should be removed.
+
+        Returns:
+        --------
+        tuple
+            The same four elements as similar_name.
+    """
+    state = MatchState(p3b_list, capture_list)  # Track the matches without modifying the originals
+    count = 0
+    key = remove_common_words if dictionary else (lambda settlement: settlement)
+
+    # Index the captures of every ward by location, and remember where each row is filed
+    locations = {}
+    for lga, wards in capture_list.items():
+        for ward, settlements in wards.items():
+            for settlement2, row in settlements.items():
+                locations[row] = (lga, ward, settlement2)
+    spatial_index = build_spatial_index(coordinates, locations)
+
+    for lga, wards in p3b_list.items():
+        for ward in wards:
+            points = p3b_points.get(lga, {}).get(ward, {})
+            for settlement in [settlement for settlement in state.remaining_p3b(lga, ward) if settlement in points]:
+                best = None
+                match = None
+                for row in get_nearby_rows(spatial_index, coordinates, *points[settlement], radius):
+                    if row not in locations:  # already matched to another settlement
+                        continue
+                    get_match = match_phrases(key(settlement), key(locations[row][2]), ratio, best)
+                    if get_match[0]:
+                        best = get_match[1]
+                        match = row
+                if match is not None:
+                    capture_lga, capture_ward, settlement2 = locations.pop(match)
+                    add_match(perfect_match, lga, ward, settlement, settlement2, state.consume(lga, ward, settlement, settlement2, capture_lga, capture_ward))
+                    count += 1
+
+    return perfect_match, state.get_p3b_list(), count, state.get_capture_list()
+
+def get_ward_key(ward):
+    """
+        Returns a ward name without the word "ward" and anything but letters and digits,
+        so that "Mayo-Inne Ward" and "mayo inne" compare equal.
+    """
+    return re.sub(r"[^a-z0-9]", "", re.sub(r"\bward\b", "", ward))
+
+def reconcile_wards(p3b_list, capture_list, LGA, ratio=0.8, aliases=None):
+    """
+        Pairs the P3B wards of an LGA that have no capture ward of the same name with the capture ward
+        they were most likely spelt as.
+
+        The alias table is looked up first. The other wards are compared, without the word "ward",
+        spaces and punctuation (see get_ward_key), to the capture wards that no P3B ward has, and
+        take the most similar one at or above the ratio. Each capture ward is paired at most once.
+
+        Args:
+            p3b_list (dict): Dictionary of settlements in P3B list.
+            capture_list (dict): Dictionary of captured settlements.
+            LGA (str): Name of the Local Government Area (LGA).
+            ratio (float, optional): The minimum similarity ratio between the ward names. Defaults to 0.8.
+            aliases (dict, optional): Capture ward names of P3B wards, as {lga: {P3B ward: capture ward}}
+                in lower case. Defaults to None.
+
+        Returns:
+            dict: The capture ward of each reconciled P3B ward.
+    """
+    lga = LGA.lower()
+    p3b_wards = p3b_list.get(lga, {})
+    capture_wards = capture_list.get(lga, {})
+    aliases = (aliases or {}).get(lga, {})
+
+    # Only the capture wards without a P3B ward of the same name can be paired
+    free = [ward for ward in capture_wards if ward not in p3b_wards]
+    reconciled = {}
+    for ward in p3b_wards:
+        if ward in capture_wards or not free:
+            continue
+        if aliases.get(ward) in free:
+            match = aliases[ward]
+        else:
+            best = None
+            match = None
+            for capture_ward in free:
+                get_match = match_phrases(get_ward_key(ward), get_ward_key(capture_ward), ratio, best)
+                if get_match[0]:
+                    best = get_match[1]
+                    match = capture_ward
+        if match is not None:
+            reconciled[ward] = match
+            free.remove(match)
+    return reconciled
+
+def rename_wards(capture_list, LGA, reconciled):
+    """
+        Returns the capture list with the reconciled wards of an LGA filed under their P3B ward names
+        (see reconcile_wards). The settlements of each ward are shared with capture_list, not copied.
+
+        Args:
+            capture_list (dict): Dictionary of captured settlements.
+            LGA (str): Name of the Local Government Area (LGA).
+            reconciled (dict): The capture ward of each reconciled P3B ward.
+
+        Returns:
+            dict: The capture list with the renamed wards.
+    """
+    lga = LGA.lower()
+    if not reconciled or lga not in capture_list:
+        return capture_list
+    names = {capture_ward: ward for ward, capture_ward in reconciled.items()}
+    return {**capture_list, lga: {names.get(ward, ward): settlements for ward, settlements in capture_list[lga].items()}}
+
+def cross_ward_name(state, perfect_match, LGA, ratio, dictionary=True, top_k=10, stats=None):
+    """
+        Matches the P3B settlements of a MatchState that are not matched yet to the captures left
+        in any ward of their LGA, for settlements filed under another ward than in the P3B list.
+
+        An n-gram index of every remaining capture of the LGA is built once, and each P3B settlement
+        only scores the top_k captures sharing the most grams with it (see get_candidates), so the
+        search does not compare every settlement to every capture of the LGA.
+
+        Args:
+            state (MatchState): The P3B and captured settlements, and the ones already matched.
+            perfect_match (dict): A dictionary to store the matching settlements.
+            LGA (str): Name of the Local Government Area (LGA).
+            ratio (float): The minimum similarity ratio between the settlement names.
+            dictionary (bool, optional): Whether the common words in the settlement names are removed. Defaults to True.
+            top_k (int, optional): Number of candidates scored for each P3B settlement. Defaults to 10.
+            stats (dict, optional): Counts of the pairs eliminated by each scoring tier (see match_phrases). Defaults to None.
+
+        Returns:
+            int: The number of settlements matched.
+    """
+    lga = LGA.lower()
+    if lga not in state.p3b_list or lga not in state.capture_list:
+        return 0
+    key = remove_common_words if dictionary else (lambda settlement: settlement)
+    count = 0
+
+    # Index the remaining captures of every ward of the LGA as (ward, settlement)
+    captures = [(ward, settlement2) for ward in state.capture_list[lga] for settlement2 in state.remaining_captures(lga, ward)]
+    index = build_ngram_index(captures, key=lambda capture: key(capture[1]))
+
+    for ward in state.p3b_list[lga]:
+        for settlement in state.remaining_p3b(lga, ward):
+            best = None
+            match = None
+            settlement_remove = key(settlement)
+            for capture in sorted(get_candidates(index, settlement_remove, top_k)):
+                get_match = match_phrases(settlement_remove, key(capture[1]), ratio, best, stats)
+                if get_match[0]:
+                    best = get_match[1]
+                    match = capture
+
+            if match is not None:
+                capture_ward, settlement2 = match
+                add_match(perfect_match, lga, ward, settlement, settlement2, state.consume(lga, ward, settlement, settlement2, lga, capture_ward))
+                count += 1
+                # A matched capture is no longer a candidate
+                for gram in get_ngrams(key(settlement2)):
+                    index[gram].discard(match)
+
+    return count
+
+def create_report(matched_settlements, unmatched_settlements, grid3=False,field_name="GRID3 Name", coordinates=None):
+    """
+        Creates the sheet of settlement data of a Local Government Area (LGA) as a DataFrame.
 
         Args:
             matched_settlements (dict): A dictionary containing matched settlements information.
             unmatched_settlements (dict): A dictionary containing unmatched settlements information.
-            LGA (str): Name of the Local Government Area (LGA).
-            file_name (str): Name of the Excel file to be created.
             grid3 (bool, optional): A boolean value indicating whether its GRID3 or RR Collect.
                                     Defaults to False.
             field_name (str, optional): Name of the field to be used for Grid3 name if grid3 is True.
                                         Defaults to "GRID3 Name".
+            coordinates (numpy.ndarray, optional): The coordinates returned by get_captured_list
+                                        with the matched settlements. Defaults to None.
 
         Returns:
-            str: A string indicating that the function has finished execution ("DONE").
+            pandas.DataFrame: The rows of the sheet.
     """
 
-    lga_name = []
-    ward_name =[]
-    p3b_name = []
-    grid3_name = []
-    capture_name= []
-    coordinate = []
-    lat  =[]
-    lon = []
-    acc = []
-    alt = []
+    # One (LGA, ward, P3B name, captured name, coordinates row) per settlement
+    records = []
 
     # Loop through the matched_settlements dictionary to extract information
-    # and append it to respective lists
     for lga, wards in matched_settlements.items():
         for ward, dhs in wards.items():
             for dh, dh2 in dhs.items():
                 text =""
-                cod_text =""
-                for name, coord in dh2.items():
+                row = -1
+                for name, capture_row in dh2.items():
                     text += f"{name}"
-                    cod_text += f"{coord}"
-                cod =cod_text.split("|")
-                lat.append(cod[0])
-                lon.append(cod[1])
-                if len(cod) ==4:
-                    acc.append(cod[2])
-                    alt.append(cod[3])
-                else:
-                    acc.append("")
-                    alt.append("")
-
-                capture_name.append(text.capitalize())
-                lga_name.append(lga.capitalize())
-                ward_name.append(ward.capitalize())
-                p3b_name.append(dh.capitalize())
+                    row = capture_row
+                records.append((lga.capitalize(), ward.capitalize(), dh.capitalize(), text.capitalize(), row))
 
     # Loop through the unmatched_settlements dictionary to extract information
-    # and append it to respective lists
     for lga, wards in unmatched_settlements.items():
         for ward, dhs in wards.items():
             for dh in dhs:
-                coordinate.append("")
-                grid3_name.append(" ")
-                capture_name.append(" ")
-                lga_name.append(lga.capitalize())
-                ward_name.append(ward.capitalize())
-                p3b_name.append(dh)
-                lat.append("")
-                lon.append("")
-                acc.append("")
-                alt.append("")
-
-    # Create pre_reconciled DataFrame with the extracted information
-    if not grid3:
-        pre_reconciled = pd.DataFrame({"LGA":lga_name,"Ward":ward_name,"DH P3B Name":p3b_name,
-                            f"{field_name}":capture_name, "Latitude":lat,"Longitude":lon,
-                            "Accuracy":acc,"Altitude":alt})
-    else:
-        pre_reconciled = pd.DataFrame({"LGA":lga_name,"Ward":ward_name,"DH P3B Name":p3b_name,
-                            f"{field_name}":capture_name, "Latitude":lat,"Longitude":lon,})
+                records.append((lga.capitalize(), ward.capitalize(), dh, " ", -1))
+
+    pre_reconciled = pd.DataFrame(records, columns=["LGA", "Ward", "DH P3B Name", f"{field_name}", "row"])
 
-    # Print pre_reconciled DataFrame
-    print(pre_reconciled)
+    # Look up the coordinates of the matched captures, unmatched settlements have none
+    rows = pre_reconciled.pop("row").to_numpy(dtype=int)
+    cod = np.full((len(rows), 4), np.nan)
+    if coordinates is not None:
+        cod[rows >= 0] = coordinates[rows[rows >= 0]]
+
+    # Add the coordinates, with accuracy and altitude for RR Collect only
+    for i, column in enumerate(coordinate_columns[:2] if grid3 else coordinate_columns):
+        pre_reconciled[column] = cod[:, i]
+    return pre_reconciled
+
+def create_excel(matched_settlements, unmatched_settlements,LGA, file_name, grid3=False,field_name="GRID3 Name", coordinates=None):
+    """
+        Creates an excel sheet with settlement data for a given Local Government Area (LGA).
+
+        The workbook is reopened and saved on every call; use add_report and write_reports
+        to write every sheet of a file at once.
+
+        Args:
+            matched_settlements (dict): A dictionary containing matched settlements information.
+            unmatched_settlements (dict): A dictionary containing unmatched settlements information.
+            LGA (str): Name of the Local Government Area (LGA).
+            file_name (str): Name of the Excel file to be created.
+            grid3 (bool, optional): A boolean value indicating whether its GRID3 or RR Collect.
+                                    Defaults to False.
+            field_name (str, optional): Name of the field to be used for Grid3 name if grid3 is True.
+                                        Defaults to "GRID3 Name".
+            coordinates (numpy.ndarray, optional): The coordinates returned by get_captured_list
+                                        with the matched settlements. Defaults to None.
+
+        Returns:
+            str: A string indicating that the function has finished execution ("DONE").
+    """
+    pre_reconciled = create_report(matched_settlements, unmatched_settlements, grid3, field_name, coordinates)
+
+    # Log the pre_reconciled DataFrame when debugging
+    logger.debug("%s sheet of %s:\n%s", LGA, file_name, pre_reconciled)
     #create excel file using file name if its not in the directory
     if not os.path.isfile(file_name):
         wb = openpyxl.Workbook()  
         wb.save(file_name)
 
-    # Open the workbook and create a writer object to write the DataFrame to the sheet
-    book = openpyxl.load_workbook(file_name)
-    writer = pd.ExcelWriter(file_name, "openpyxl")
-    writer.book =book
+    # Open the workbook in append mode and write the DataFrame to a new sheet
+    writer = pd.ExcelWriter(file_name, "openpyxl", mode="a", if_sheet_exists="new")
     pre_reconciled.to_excel(writer, sheet_name=f'{LGA}',index=False )
     writer.close()
     return "DONE"
 
-def run(state):
+def add_report(reports, file_name, LGA, report):
+    """
+        Collects the sheet of a Local Government Area (LGA) to be written later by write_reports,
+        or writes it straight away to its dataset if reports is a ReportWriter.
+
+        Args:
+            reports (dict or ReportWriter): A dictionary where keys are file names and values are dictionaries
+                            of sheets (LGA name to DataFrame), in the order they were added.
+            file_name (str): Name of the Excel file the sheet belongs to.
+            LGA (str): Name of the Local Government Area (LGA), used as the sheet name.
+            report (pandas.DataFrame): The sheet, as returned by create_report.
+
+        Returns:
+            dict: The updated reports dictionary.
+    """
+    if isinstance(reports, ReportWriter):
+        reports.add(file_name, LGA, report)
+        return reports
+    if file_name not in reports:
+        reports[file_name] = {}
+    reports[file_name][f"{LGA}"] = report
+    return reports
+
+def write_reports(reports, write_only=False):
+    """
+        Writes every collected Excel file once, with one sheet per Local Government Area (LGA).
+        Existing files are replaced.
+
+        Args:
+            reports (dict): The sheets collected by add_report.
+            write_only (bool, optional): Stream the rows with an openpyxl write-only workbook,
+                                         which keeps memory low for large files. Defaults to False.
+
+        Returns:
+            str: A string indicating that the function has finished execution ("DONE").
+    """
+    for file_name, sheets in reports.items():
+        if write_only:
+            book = openpyxl.Workbook(write_only=True)
+            for LGA, report in sheets.items():
+                sheet = book.create_sheet(LGA)
+                sheet.append(list(report.columns))
+                for row in report.itertuples(index=False):
+                    # Missing coordinates are left as empty cells
+                    sheet.append([None if pd.isna(value) else value for value in row])
+            book.save(file_name)
+        else:
+            with pd.ExcelWriter(file_name, engine="openpyxl") as writer:
+                for LGA, report in sheets.items():
+                    report.to_excel(writer, sheet_name=LGA, index=False)
+    return "DONE"
+
+class ReportWriter:
+    """
+        Streams the sheets of each output file to a CSV dataset partitioned by Local Government Area (LGA):
+        <output_dir>/<file name without extension>/LGA=<LGA>/part-0.csv. Each sheet is written as soon
+        as it is added, so only the sheets of one LGA are in memory, and the files can be read by
+        scripts directly or exported to Excel at the end (see export_excel).
+
+        Args:
+            output_dir (str): The directory of the datasets.
+    """
+    extension = "csv"
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.datasets = {}
+
+    def get_dataset(self, file_name):
+        """
+            Returns the directory of the dataset of an output file.
+        """
+        return os.path.join(self.output_dir, os.path.splitext(os.path.basename(file_name))[0])
+
+    def add(self, file_name, LGA, report):
+        """
+            Writes the sheet of an LGA to its partition of the dataset of file_name, replacing an older one.
+        """
+        partition = os.path.join(self.get_dataset(file_name), f"LGA={LGA}")
+        os.makedirs(partition, exist_ok=True)
+        path = os.path.join(partition, f"part-0.{self.extension}")
+        # Write to a temporary file first so an interrupted run never leaves half a partition
+        self.write(report, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        if file_name not in self.datasets:
+            self.datasets[file_name] = []
+        self.datasets[file_name].append(f"{LGA}")
+
+    def write(self, report, path):
+        """
+            Writes one sheet to a file.
+        """
+        report.to_csv(path, index=False)
+
+    def close(self, excel=False, write_only=False):
+        """
+            Finishes the datasets, exporting each one to its Excel file if excel is True (see export_excel).
+
+            Returns:
+                dict: The LGAs written to the dataset of each file, in order.
+        """
+        if excel:
+            for file_name, LGAs in self.datasets.items():
+                export_excel(self.get_dataset(file_name), file_name, LGAs, write_only)
+        return self.datasets
+
+class ParquetReportWriter(ReportWriter):
+    """
+        Streams the sheets of each output file to a Parquet dataset partitioned by LGA (see ReportWriter).
+        Needs the pyarrow package.
+    """
+    extension = "parquet"
+
+    def __init__(self, output_dir):
+        if pyarrow is None:
+            raise ImportError("The Parquet report writer needs the pyarrow package")
+        super().__init__(output_dir)
+
+    def write(self, report, path):
+        report.to_parquet(path, index=False)
+
+# Report writers of run(), by output format. "excel" collects the sheets and writes them with write_reports
+report_writers = {
+    "csv": ReportWriter,
+    "parquet": ParquetReportWriter,
+}
+
+def read_partition(dataset, LGA):
+    """
+        Reads the sheet of a Local Government Area (LGA) back from a dataset written by a ReportWriter.
+
+        Args:
+            dataset (str): The directory of the dataset.
+            LGA (str): Name of the LGA.
+
+        Returns:
+            pandas.DataFrame: The sheet, with the names as text and the coordinates as numbers.
+    """
+    partition = os.path.join(dataset, f"LGA={LGA}")
+    path = os.path.join(partition, "part-0.parquet")
+    if os.path.isfile(path):
+        return pd.read_parquet(path)
+
+    # Only empty cells are missing, so names such as "NA" stay names
+    report = pd.read_csv(os.path.join(partition, "part-0.csv"), dtype=str, keep_default_na=False, na_values=[""])
+    for column in coordinate_columns:
+        if column in report:
+            report[column] = pd.to_numeric(report[column])
+    return report
+
+def export_excel(dataset, file_name, LGAs=None, write_only=False):
+    """
+        Exports a dataset written by a ReportWriter to an Excel file with one sheet per Local Government Area (LGA).
+
+        Args:
+            dataset (str): The directory of the dataset.
+            file_name (str): The Excel file to write. An existing file is replaced.
+            LGAs (list, optional): The LGAs to export, in sheet order. Defaults to None, which exports
+                every partition of the dataset in name order.
+            write_only (bool, optional): See write_reports. Defaults to False.
+
+        Returns:
+            str: A string indicating that the function has finished execution ("DONE").
+    """
+    if LGAs is None:
+        LGAs = sorted(name[len("LGA="):] for name in os.listdir(dataset) if name.startswith("LGA="))
+    return write_reports({file_name: {LGA: read_partition(dataset, LGA) for LGA in LGAs}}, write_only)
+
+def match_lga(local_gov, p3b, grid3_list, rr_collect_list, grid3_coordinates=None, rr_collect_coordinates=None, radius=None, assignment="greedy", keep_state=False, instrument=False, scorer="difflib", cross_ward=False, ward_aliases=None, top_k=None):
+    """
+        Runs the matching passes of one Local Government Area (LGA) against GRID3 and RR Collect.
+
+        The LGA is independent of every other LGA, so this can run in a worker process.
+        Nothing is written to disk here.
+
+        Args:
+            local_gov (str): Name of the Local Government Area (LGA).
+            p3b (pandas.DataFrame): The P3B sheet of the LGA.
+            grid3_list (dict): The GRID3 settlements of the LGA (see get_lga_captures).
+            rr_collect_list (dict): The RR Collect settlements of the LGA (see get_lga_captures).
+            grid3_coordinates (numpy.ndarray, optional): The GRID3 coordinates (see get_captured_list).
+            rr_collect_coordinates (numpy.ndarray, optional): The RR Collect coordinates.
+            radius (float, optional): If given and the P3B sheet has Latitude and Longitude columns,
+                P3B settlements are first matched at 0.75 to the captures within this many kilometres,
+                in any ward of the LGA (see nearby_name). Defaults to None.
+            assignment (str, optional): "greedy" or "optimal" matching of each ward in the
+                similar name passes (see match_similar). Defaults to "greedy".
+            keep_state (bool, optional): Also return what update_run needs to re-match the RR Collect
+                passes: the P3B settlements and GRID3 captures left after the GRID3 passes
+                ("grid3_not_matched", "grid3_remaining"). Defaults to False.
+            instrument (bool, optional): Also return the records of every pass of the LGA as "stages"
+                (see record_stage), tracing memory with tracemalloc while the LGA is matched. Defaults to False.
+            scorer (str, optional): The scorer of the similar name passes (see match_similar). Defaults to "difflib".
+            cross_ward (bool, optional): Pair the P3B wards with the capture wards spelt differently first
+                (see reconcile_wards), and after the similar name passes of each source, match the P3B
+                settlements left to the captures left in any ward of the LGA at 0.85 (see cross_ward_name).
+                Defaults to False.
+            ward_aliases (dict, optional): Capture ward names of P3B wards used when cross_ward is True
+                (see reconcile_wards). Defaults to None.
+            top_k (int, optional): Only score the top_k captures of the blocking index in the similar
+                name passes (see similar_name). Defaults to None, which scores every pair.
+
+        Returns:
+            dict: The GRID3 matches, RR Collect matches, below threshold matches of each source
+                and the settlements that did not match at all.
+    """
+    stages = [] if instrument else None
+
+    # Trace the memory of each pass, unless the caller already does (run() in the same process)
+    tracing = instrument and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+
+    # Get a list of settlements in the P3B data for the current LGA
+    # and the total number of settlements in the P3B data for the current LGA
+    start = start_stage()
+    p3b_list, total_settlement = get_p3b_list(p3b,local_gov,)
+    p3b_points = get_p3b_points(p3b, local_gov) if radius else {}
+    record_stage(stages, local_gov, "p3b list", start)
+
+    # File the grid3 wards spelt differently under their P3B ward names
+    if cross_ward:
+        grid3_list = rename_wards(grid3_list, local_gov, reconcile_wards(p3b_list, grid3_list, local_gov, aliases=ward_aliases))
+
+    # Match settlements in the P3B data to settlements in the grid3 data
+    start = start_stage()
+    grid3_perfect = {}
+    updated_p3B_list, updated_grid3_list, grid3_perfect, same_matched = matching_same_name(p3b_list,grid3_list,grid3_perfect,local_gov)
+    record_stage(stages, local_gov, "grid3 exact", start, matches=same_matched)
+
+    # Match the settlements with coordinates to the grid3 settlements around them
+    if p3b_points:
+        start = start_stage()
+        grid3_perfect, updated_p3B_list, nearby_matched, updated_grid3_list = nearby_name(updated_p3B_list,p3b_points,updated_grid3_list,grid3_coordinates,grid3_perfect,local_gov,.75,radius,dictionary=True)
+        record_stage(stages, local_gov, "grid3 nearby", start, matches=nearby_matched)
+
+    # Match settlements in the P3B data that were not matched in the first pass to
+    # settlements in the grid3 data using a similarity threshold of 0.9
+    # and then those not matched in the second pass using a similarity threshold of 0.75.
+    # Every pair is scored once in grid3_scores for all the grid3 passes, which only
+    # keeps the pairs that can reach the 0.6 of the below threshold pass
+    grid3_state = MatchState(updated_p3B_list, updated_grid3_list)
+    grid3_scores = {}
+    similar_matched_7, similar_matched_5 = cascade_match(grid3_state,grid3_perfect,[(.9, False), (.75, True)],grid3_scores,assignment,stages,"grid3 similar",local_gov,scorer,.6,top_k)
+
+    # Look for the settlements left in the other wards of the LGA, with a higher
+    # threshold as every capture of the LGA can now be a candidate
+    if cross_ward:
+        start = start_stage()
+        stats = {} if stages is not None else None
+        cross_matched = cross_ward_name(grid3_state,grid3_perfect,local_gov,.85,stats=stats)
+        record_stage(stages, local_gov, "grid3 cross ward", start, stats, cross_matched)
+    not_matched = grid3_state.get_p3b_list()
+    grid3_remaining = grid3_state.get_capture_list()
+
+    result = {"grid3": grid3_perfect}
+    if keep_state:
+        # Copy the lists, as the exact match of the RR Collect passes removes names from them
+        result.update({"grid3_not_matched": {lga: {ward: list(settlements) for ward, settlements in wards.items()}
+                                             for lga, wards in not_matched.items()},
+                       "grid3_remaining": grid3_remaining})
+
+    result.update(match_rr_collect(local_gov, not_matched, grid3_remaining, rr_collect_list, grid3_scores,
+                                   p3b_points, rr_collect_coordinates, radius, assignment, stages, scorer,
+                                   cross_ward, ward_aliases, top_k))
+    if tracing:
+        tracemalloc.stop()
+    if instrument:
+        result["stages"] = stages
+    return result
+
+def match_rr_collect(local_gov, not_matched, grid3_remaining, rr_collect_list, grid3_scores, p3b_points=None, rr_collect_coordinates=None, radius=None, assignment="greedy", stages=None, scorer="difflib", cross_ward=False, ward_aliases=None, top_k=None):
+    """
+        Runs the passes of one Local Government Area (LGA) that follow the GRID3 passes: RR Collect,
+        then the below threshold passes against GRID3 and RR Collect.
+
+        Every pass works ward by ward, so running this on some wards of the LGA gives
+        the same results for those wards as running it on all of them.
+
+        Args:
+            local_gov (str): Name of the Local Government Area (LGA).
+            not_matched (dict): The P3B settlements not matched by the GRID3 passes. Matched names are removed from it.
+            grid3_remaining (dict): The GRID3 settlements not matched by the GRID3 passes.
+            grid3_scores (dict): The score table of the GRID3 passes (see cascade_match), or an empty one
+                when they were run earlier, as in update_run.
+            p3b_points (dict, optional): The coordinates of the P3B settlements (see get_p3b_points). Defaults to None.
+            rr_collect_coordinates (numpy.ndarray, optional): The RR Collect coordinates. Defaults to None.
+            radius (float, optional): See match_lga. Defaults to None.
+            assignment (str, optional): See match_lga. Defaults to "greedy".
+            stages (list, optional): If given, every pass is recorded in it (see record_stage). Defaults to None.
+            scorer (str, optional): See match_lga. Defaults to "difflib".
+            cross_ward (bool, optional): See match_lga. Defaults to False.
+            ward_aliases (dict, optional): See match_lga. Defaults to None.
+            top_k (int, optional): See match_lga. Defaults to None.
+
+        Returns:
+            dict: The RR Collect matches, below threshold matches of each source and the settlements that did not match at all.
+    """
+    # Match settlements in the P3B data that were not matched in the first pass to rr_collect data
+    # File the rr_collect wards spelt differently under their P3B ward names
+    if cross_ward:
+        rr_collect_list = rename_wards(rr_collect_list, local_gov, reconcile_wards(not_matched, rr_collect_list, local_gov, aliases=ward_aliases))
+
+    start = start_stage()
+    rr_collect_perfect ={}
+    # Perform exact name matching between not_matched settlements from p3b data and rr_collect data
+    updated_not_matched, updated_rr_collect_list, rr_collect_perfect, same_matched = matching_same_name(not_matched,rr_collect_list,rr_collect_perfect,local_gov)
+    record_stage(stages, local_gov, "rr_collect exact", start, matches=same_matched)
+
+    # Match the settlements with coordinates to the rr_collect settlements around them
+    if p3b_points:
+        start = start_stage()
+        rr_collect_perfect, updated_not_matched, nearby_matched, updated_rr_collect_list = nearby_name(updated_not_matched,p3b_points,updated_rr_collect_list,rr_collect_coordinates,rr_collect_perfect,local_gov,.75,radius,dictionary=True)
+        record_stage(stages, local_gov, "rr_collect nearby", start, matches=nearby_matched)
+   
+    # Match settlements in the P3B data that were not matched in the second pass to
+    # settlements in  rr_collect data using a similarity threshold of 0.9, and then 0.75
+    rr_collect_state = MatchState(updated_not_matched, updated_rr_collect_list)
+    rr_collect_scores = {}
+    similar_matched_7, similar_matched_5 = cascade_match(rr_collect_state,rr_collect_perfect,[(.9, False), (.75, True)],rr_collect_scores,assignment,stages,"rr_collect similar",local_gov,scorer,.6,top_k)
+
+    # Look for the settlements left in the other wards of the LGA, with a higher
+    # threshold as every capture of the LGA can now be a candidate
+    if cross_ward:
+        start = start_stage()
+        stats = {} if stages is not None else None
+        cross_matched = cross_ward_name(rr_collect_state,rr_collect_perfect,local_gov,.85,stats=stats)
+        record_stage(stages, local_gov, "rr_collect cross ward", start, stats, cross_matched)
+
+    # Match settlements that did not macthed at all using lower threshold
+    # Perform similar name matching between updated_not_matched settlements from p3b data and grid3 data with threshold of 0.6
+    below_grid3 ={}
+    grid3_state = MatchState(rr_collect_state.get_p3b_list(), grid3_remaining)
+    similar_matched_5, = cascade_match(grid3_state,below_grid3,[(.6, True)],grid3_scores,assignment,stages,"below grid3 similar",local_gov,scorer,top_k=top_k)
+
+    # Perform similar name matching between updated_not_matched settlements from p3b data and rr collect data data with threshold of 0.6
+    below_rr_collect ={}
+    rr_collect_state = MatchState(grid3_state.get_p3b_list(), rr_collect_state.get_capture_list())
+    similar_matched_5, = cascade_match(rr_collect_state,below_rr_collect,[(.6, True)],rr_collect_scores,assignment,stages,"below rr_collect similar",local_gov,scorer,top_k=top_k)
+    updated_not_matched = rr_collect_state.get_p3b_list()
+
+    return {"rr_collect": rr_collect_perfect, "below_grid3": below_grid3,
+            "below_rr_collect": below_rr_collect, "no_match": updated_not_matched}
+
+def add_lga_reports(reports, local_gov, result, grid3_coordinates, rr_collect_coordinates, grid3=True):
+    """
+        Adds the sheets of one Local Government Area (LGA) to every output file (see add_report).
+
+        Args:
+            reports (dict): The sheets collected so far.
+            local_gov (str): Name of the Local Government Area (LGA).
+            result (dict): The results of match_lga for the LGA.
+            grid3_coordinates (numpy.ndarray): The GRID3 coordinates.
+            rr_collect_coordinates (numpy.ndarray): The RR Collect coordinates.
+            grid3 (bool, optional): Whether to add the GRID3 matches sheet. Defaults to True.
+
+        Returns:
+            dict: The updated reports dictionary.
+    """
+    # Add the GRID3 matching results of the current LGA
+    if grid3:
+        add_report(reports, file_to_save_GRID3, local_gov, create_report(result["grid3"],{},True,coordinates=grid3_coordinates))
+
+    # Add the matched settlements between not_matched settlements from p3b data and rr_collect data
+    add_report(reports, file_to_save_rr_collect, local_gov, create_report(result["rr_collect"],{},field_name="RR Collect Name",coordinates=rr_collect_coordinates))
+
+    # Add the below threshold matches to their own files
+    add_report(reports, "below_threshold_GRID3.xlsx", local_gov, create_report(result["below_grid3"],{},coordinates=grid3_coordinates))
+    add_report(reports, "below_threshold_RR_collect.xlsx", local_gov, create_report(result["below_rr_collect"],{},field_name="RR Collect Name",coordinates=rr_collect_coordinates))
+
+    # Add the not matched items
+    add_report(reports, no_match_file, local_gov, create_report({},result["no_match"]))
+    return reports
+
+def run(state, workers=None, write_only=False, radius=None, assignment="greedy", cache_dir=None, state_file=None, report_file=None, profile_file=None, scorer="difflib", cross_ward=False, ward_aliases=None, prefetch=True, output_format="excel", output_dir=".", excel=False, top_k=None):
     """
         Runs the matching process for each Local Government Area (LGA) in Adamawa state.
 
@@ -389,89 +1830,327 @@ def run(state):
         as well as the P3B data for each LGA. Matches settlements in the P3B data to settlements in the
         grid3 and RR Collection data, then writes the results to separate Excel files for each LGA.
 
+        Args:
+            state (list): The LGAs of the state.
+            workers (int, optional): Number of worker processes matching LGAs in parallel.
+                Defaults to None, which matches the LGAs one after another. The results are
+                written by this process in LGA order either way, so the output is the same.
+            write_only (bool, optional): Stream the Excel files with write-only workbooks.
+                Defaults to False.
+            radius (float, optional): Search radius in kilometres for P3B settlements with
+                coordinates (see match_lga). Defaults to None, which matches by name only.
+            assignment (str, optional): "greedy" or "optimal" matching of each ward (see match_similar).
+                Defaults to "greedy".
+            cache_dir (str, optional): Directory where the parsed GRID3 and RR Collect files are
+                cached between runs (see load_captured_list). Defaults to None (no cache).
+            state_file (str, optional): File where the matching state of the run is saved for
+                update_run. Defaults to None (not saved).
+            report_file (str, optional): File where the wall/CPU time, pairs compared, matches and
+                memory of every stage of every LGA are written, as CSV if it ends with ".csv" and
+                JSON otherwise (see record_stage). Memory is traced with tracemalloc while recording,
+                which slows the run down. Defaults to None (not recorded).
+            profile_file (str, optional): File where cProfile statistics of the run are dumped, to be read
+                with pstats. Only this process is profiled, so with workers the matching itself is not
+                included. Defaults to None (not profiled).
+            scorer (str, optional): The scorer of the similar name passes: "difflib", "rapidfuzz"
+                (same matches, needs rapidfuzz) or "rapidfuzz-indel" (see match_similar). Defaults to "difflib".
+            cross_ward (bool, optional): Reconcile ward spellings and match the settlements left across
+                the wards of their LGA (see match_lga). Defaults to False.
+            ward_aliases (dict, optional): Capture ward names of P3B wards, as {lga: {P3B ward: capture ward}}
+                (see reconcile_wards). Defaults to None.
+            prefetch (bool, optional): Parse the P3B sheets in a background thread while the LGAs
+                already read are matched. Defaults to True. Only used without workers: the workers
+                already match while the sheets are read, and forking them while a thread runs can
+                deadlock them. The P3B workbook is opened once either way, and its sheets are
+                cached in cache_dir if given (see load_p3b_sheets).
+            output_format (str, optional): "excel" writes the Excel files after the last LGA. "csv" and
+                "parquet" stream the sheets of each LGA to one dataset per file in output_dir as they
+                are produced (see ReportWriter). Defaults to "excel".
+            output_dir (str, optional): The directory of the csv or parquet datasets. Defaults to ".".
+            excel (bool, optional): Also export the csv or parquet datasets to the Excel files at the end.
+                Defaults to False.
+            top_k (int, optional): Only score the top_k captures sharing the most trigrams with each P3B
+                settlement in the similar name passes, which is faster on large wards but can miss
+                matches (see similar_name and blocking_recall). Defaults to None, which scores every pair.
+
         Returns nothing.
     """
+    profiler = cProfile.Profile() if profile_file else None
+    if profiler is not None:
+        profiler.enable()
+    stages = [] if report_file else None
+    # Trace memory for the stage records, which slows the run down
+    tracing = stages is not None and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+
+    # Drop the names stripped by earlier runs of this process
+    remove_common_words.cache_clear()
+
     # Read in the data files for settlements captured in grid3 and RR Collection exercises
-    grid3_file= pd.read_csv("")
-    rr_collect_file = pd.read_csv("")
-
-    #files where the matching with rr_collect and grid3 are to be save
-    file_to_save_GRID3 =""
-    file_to_save_rr_collect =""
-    no_match_file = ""
-
-    # Create a dictionary to hold the matching results for each LGA
-  
-    # Iterate over each LGA
-    for local_gov in state:
-        # Read in the P3B data for the current LGA
-        p3b =  pd.read_excel("", f'{local_gov}'.upper())
-
-        # Get a list of settlements in the P3B data for the current LGA
-        # and the total number of settlements in the P3B data for the current LGA
-        p3b_list, total_settlement = get_p3b_list(p3b,local_gov,)
-
-        # Get a list of settlements captured in grid3 for the current LGA,
-        # and match settlements in the P3B data to settlements in the grid3 data
-        grid3_list = get_captured_list(grid3_file,local_gov,True)
-        rr_collect_list = get_captured_list(rr_collect_file,local_gov,True)
-
-        perfect = {}
-        updated_p3B_list, updated_grid3_list, perfect, same_matched = matching_same_name(p3b_list,grid3_list,perfect,local_gov)
-
-        # Match settlements in the P3B data that were not matched in the first pass to
-        # settlements in the grid3 data using a similarity threshold of 0.9
-        perfect, not_matched, similar_matched_7, updated_grid3_list = similar_name(updated_p3B_list, updated_grid3_list,perfect,local_gov,.9)
-
-        # Match settlements in the P3B data that were not matched in the second pass to
-        # settlements in the grid3 data using a similarity threshold of 0.75
-        perfect, not_matched, similar_matched_5, updated_grid3_list= similar_name(not_matched,updated_grid3_list,perfect,local_gov,.75,dictionary=True)
-
-        # Write the matching results to an Excel file for the current LGA
-        create_excel(perfect,{},local_gov,file_to_save_GRID3,True)
-
-        # Print a message indicating that the matching process for the current LGA is complete
-        print("Done...........................................")
-        print("Finish GRID3...........................................||||||||||||||||||||||||||||||||||")
-
-        # Match settlements in the P3B data that were not matched in the first pass to rr_collect data
-        perfect ={}
-        # Perform exact name matching between not_matched settlements from p3b data and rr_collect data
-        updated_not_matched, updated_rr_collect_list, perfect, same_matched = matching_same_name(not_matched,rr_collect_list,perfect,local_gov)
-       
-        # Match settlements in the P3B data that were not matched in the second pass to
-        # settlements in  rr_collect data using a similarity threshold of 0.9
-        perfect, updated_not_matched, similar_matched_7, updated_rr_collect_list = similar_name(updated_not_matched, updated_rr_collect_list,perfect,local_gov,.9)
-
-        # Match settlements in the P3B data that were not matched in the second pass to
-        # settlements in  rr_collect data using a similarity threshold of 0.75
-        perfect, updated_not_matched, similar_matched_5, updated_rr_collect_list= similar_name(updated_not_matched,updated_rr_collect_list,perfect,local_gov,.75,dictionary=True)
-       
-        # Create an excel file with matched settlements between not_matched settlements from p3b data and rr_collect data
-        create_excel(perfect,{},local_gov,file_to_save_rr_collect,field_name="RR Collect Name")
-        print("Done...........................................")
-        print("Finish rr collect...........................................||||||||||||||||||||||||||||||||||")
-
-
-        # Match settlements that did not macthed at all using lower threshold and append to another file
-        # Perform similar name matching between updated_not_matched settlements from p3b data and grid3 data with threshold of 0.6
-        perfect ={}
-        perfect, updated_not_matched, similar_matched_5, updated_grid3_list= similar_name(updated_not_matched,updated_grid3_list,perfect,local_gov,.6,dictionary=True)
-        create_excel(perfect,{},local_gov,"below_threshold_GRID3.xlsx")
-        print("Done...........................................")
-        
-        # Perform similar name matching between updated_not_matched settlements from p3b data and rr collect data data with threshold of 0.6
+    # and partition the captured settlements by LGA once for the whole state
+    start = start_stage()
+    grid3_hash = get_file_hash(grid3_filename) if state_file is not None else None
+    grid3_store, grid3_coordinates = load_captured_list(grid3_filename, grid3=True, cache_dir=cache_dir)
+    record_stage(stages, "state", "load grid3", start)
+    start = start_stage()
+    rr_collect_store, rr_collect_coordinates = load_captured_list(rr_collect_filename, grid3=True, cache_dir=cache_dir)
+    record_stage(stages, "state", "load rr_collect", start)
+
+    # Keep the RR Collect captures as they were matched: the matching pops them from the store,
+    # and the files may change before the run ends
+    if state_file is not None:
+        rr_collect_saved = {lga: {ward: dict(settlements) for ward, settlements in wards.items()}
+                            for lga, wards in rr_collect_store.items()}
+        rr_collect_coordinates_saved = np.array(rr_collect_coordinates)
+
+    # Read in the P3B data of each LGA from one pass over the workbook
+    sheets = load_p3b_sheets(p3b_filename, state, cache_dir)
+    pool = workers is not None and workers > 1
+    if prefetch and not pool:
+        sheets = prefetch_items(sheets)
+
+    def get_jobs():
+        # The captured settlements of each LGA go with its P3B sheet as the sheet is read
+        start = start_stage()
+        for local_gov, p3b in sheets:
+            record_stage(stages, local_gov, "load p3b", start)
+            yield (local_gov, p3b, get_lga_captures(grid3_store,local_gov), get_lga_captures(rr_collect_store,local_gov),
+                   grid3_coordinates if radius else None, rr_collect_coordinates if radius else None, radius, assignment,
+                   state_file is not None, stages is not None, scorer, cross_ward, ward_aliases, top_k)
+            start = start_stage()
+
+    executor = ProcessPoolExecutor(max_workers=workers) if pool else None
+    try:
+        if executor is not None:
+            # Each LGA is submitted as soon as its sheet is read
+            futures = [executor.submit(match_lga, *job) for job in get_jobs()]
+            results = (future.result() for future in futures)
+        else:
+            results = (match_lga(*job) for job in get_jobs())
+
+        # Collect the sheets of each LGA as they come in, in LGA order. Only this process
+        # writes: once per file after the last LGA, or each LGA as it comes for the datasets
+        reports = {} if output_format == "excel" else report_writers[output_format](output_dir)
+        lga_results = {}
+        for local_gov, result in zip(state, results):
+            if stages is not None:
+                stages += result.pop("stages")
+            start = start_stage()
+            add_lga_reports(reports, local_gov, result, grid3_coordinates, rr_collect_coordinates)
+            record_stage(stages, local_gov, "reports", start)
+            if state_file is not None:
+                lga_results[local_gov] = result
+
+            # Log a message indicating that the matching process for the current LGA is complete
+            logger.info("Done %s", local_gov)
+
+        start = start_stage()
+        if isinstance(reports, ReportWriter):
+            reports.close(excel, write_only)
+        else:
+            write_reports(reports, write_only)
+        # Named after what was written, e.g. "write csv" or "write csv and excel"
+        exported = " and excel" if excel and output_format != "excel" else ""
+        record_stage(stages, "state", f"write {output_format}{exported}", start)
+    finally:
+        # Stop the workers whether the run finished or failed, dropping the LGAs not started yet,
+        # and stop reading the P3B sheets, which closes the workbook
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        sheets.close()
 
-        perfect ={}
-        perfect, updated_not_matched, similar_matched_5, updated_rr_collect_list= similar_name(updated_not_matched,updated_rr_collect_list,perfect,local_gov,.6,dictionary=True)
-      
-        create_excel(perfect,{},local_gov,"below_threshold_RR_collect.xlsx",field_name="RR Collect Name")
+    # Save what update_run needs to re-match new RR Collect submissions
+    if state_file is not None:
+        run_state = {"grid3_hash": grid3_hash, "radius": radius, "assignment": assignment, "scorer": scorer, "cross_ward": cross_ward,
+                     "grid3_coordinates": np.asarray(grid3_coordinates), "rr_collect": rr_collect_saved,
+                     "rr_collect_coordinates": rr_collect_coordinates_saved, "lgas": lga_results,
+                     "output_format": output_format, "output_dir": output_dir, "excel": excel, "write_only": write_only,
+                     "top_k": top_k}
+        save_run_state(run_state, state_file)
 
-        # Create Excel file with the not matched items
-        create_excel({},updated_not_matched,local_gov,no_match_file)
+    if tracing:
+        tracemalloc.stop()
+    if stages is not None:
+        write_run_report(stages, report_file)
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+    logger.info("Finish")
+
+def get_changed_wards(old_list, old_coordinates, new_list, new_coordinates):
+    """
+        Compares the captured settlements of one LGA in two versions of a capture file.
+
+        Args:
+            old_list (dict): The wards of the LGA in the old version.
+            old_coordinates (numpy.ndarray): The coordinates of the old version.
+            new_list (dict): The wards of the LGA in the new version.
+            new_coordinates (numpy.ndarray): The coordinates of the new version.
+
+        Returns:
+            set: The wards with captures added, removed, reordered or moved.
+    """
+    changed = set()
+    for ward in set(old_list) | set(new_list):
+        old = old_list.get(ward, {})
+        new = new_list.get(ward, {})
+        if list(old) != list(new):
+            changed.add(ward)
+        elif old and not np.array_equal(old_coordinates[list(old.values())], new_coordinates[list(new.values())], equal_nan=True):
+            changed.add(ward)
+    return changed
+
+def save_run_state(run_state, state_file):
+    """
+        Saves the matching state of a run for update_run.
+
+        The state is written to a temporary file first, so an interrupted save
+        leaves the previous state file as it was.
+
+        Args:
+            run_state (dict): The matching state (see run).
+            state_file (str): The file to save it to.
+    """
+    with open(f"{state_file}.tmp", "wb") as file:
+        pickle.dump(run_state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{state_file}.tmp", state_file)
+
+def select_wards(settlements, lga, wards):
+    """
+        Returns a dictionary with the given wards of one LGA, with copies of their settlements.
+    """
+    return {lga: {ward: type(values)(values) for ward, values in settlements.get(lga, {}).items() if ward in wards}}
+
+def merge_wards(old, new, lga, wards):
+    """
+        Replaces the given wards of one LGA in a result dictionary with their new results.
+        Wards keep their position; wards only in the new results are added at the end.
+    """
+    merged = {}
+    for ward, values in old.get(lga, {}).items():
+        if ward not in wards:
+            merged[ward] = values
+        elif ward in new.get(lga, {}):
+            merged[ward] = new[lga][ward]
+    for ward, values in new.get(lga, {}).items():
+        if ward not in merged:
+            merged[ward] = values
+    if merged or lga in old:
+        old[lga] = merged
+    return old
+
+def patch_reports(reports):
+    """
+        Replaces the sheets of the collected Local Government Areas (LGA) in existing Excel
+        files, keeping their other sheets and the sheet order.
+
+        Args:
+            reports (dict): The sheets collected by add_report.
+
+        Returns:
+            str: A string indicating that the function has finished execution ("DONE").
+
+        Raises:
+            FileNotFoundError: If one of the files is missing. Nothing is written then, since
+                the collected sheets alone would leave out the other LGAs.
+    """
+    missing = [file_name for file_name in reports if not os.path.isfile(file_name)]
+    if missing:
+        raise FileNotFoundError(f"{', '.join(missing)} not found, run() again")
+    for file_name, sheets in reports.items():
+        book = openpyxl.load_workbook(file_name)
+        for LGA, report in sheets.items():
+            position = len(book.sheetnames)
+            if LGA in book.sheetnames:
+                position = book.sheetnames.index(LGA)
+                book.remove(book[LGA])
+            sheet = book.create_sheet(LGA, position)
+            sheet.append(list(report.columns))
+            for row in report.itertuples(index=False):
+                # Missing coordinates are left as empty cells
+                sheet.append([None if pd.isna(value) else value for value in row])
+        book.save(file_name)
+    return "DONE"
+
+def update_run(state_file, cache_dir=None):
+    """
+        Re-matches the RR Collect submissions that changed since the run saved in state_file.
+
+        Only the wards whose RR Collect captures were added, removed or moved are matched again,
+        from the RR Collect passes onwards (the GRID3 passes do not depend on RR Collect), and only
+        the sheets of their LGAs are replaced in the RR Collect, below threshold and no match files.
+        The outputs are updated in the format of the saved run: sheets of Excel files in place
+        (see patch_reports), or partitions of csv or parquet datasets, exported to Excel again
+        if the run exported them. The matches are the same as a full run; rows of a re-matched
+        ward may come at the end of its LGA's sheet. The state file is updated for the next call.
+
+        Args:
+            state_file (str): The file saved by run(state_file=...).
+            cache_dir (str, optional): See load_captured_list. Defaults to None.
+
+        Returns:
+            dict: The re-matched wards of each LGA.
+    """
+    with open(state_file, "rb") as file:
+        run_state = pickle.load(file)
+
+    # Drop the names stripped by earlier runs of this process
+    remove_common_words.cache_clear()
+
+    # The saved GRID3 results are only valid for the same GRID3 file, and proximity
+    # matching crosses wards, so those runs have to be done again in full
+    if run_state["grid3_hash"] != get_file_hash(grid3_filename):
+        raise ValueError("The GRID3 file changed since the saved run, run() again")
+    if run_state["radius"] or run_state["cross_ward"]:
+        raise ValueError("Runs with a radius or cross_ward match across wards and cannot be updated, run() again")
+
+    rr_collect_store, rr_collect_coordinates = load_captured_list(rr_collect_filename, grid3=True, cache_dir=cache_dir)
+    # State files saved before the output format was recorded come from Excel runs
+    output_format = run_state.get("output_format", "excel")
+    reports = {} if output_format == "excel" else report_writers[output_format](run_state.get("output_dir", "."))
+    updated = {}
+    for local_gov, result in run_state["lgas"].items():
+        lga = local_gov.lower()
+        wards = get_changed_wards(run_state["rr_collect"].get(lga, {}), run_state["rr_collect_coordinates"],
+                                  rr_collect_store.get(lga, {}), rr_collect_coordinates)
+
+        # Match the changed wards again and put their results in place of the old ones
+        wards &= set(result["grid3_not_matched"].get(lga, {}))
+        if wards:
+            ward_result = match_rr_collect(local_gov, select_wards(result["grid3_not_matched"], lga, wards),
+                                           select_wards(result["grid3_remaining"], lga, wards),
+                                           select_wards(rr_collect_store, lga, wards), {},
+                                           assignment=run_state["assignment"], scorer=run_state["scorer"],
+                                           top_k=run_state.get("top_k"))
+            for key in ["rr_collect", "below_grid3", "below_rr_collect", "no_match"]:
+                merge_wards(result[key], ward_result[key], lga, wards)
+            updated[local_gov] = wards
+
+        # Point the RR Collect matches to the rows of the new file
+        for key in ["rr_collect", "below_rr_collect"]:
+            for ward, dhs in result[key].get(lga, {}).items():
+                for dh, dh2 in dhs.items():
+                    for name in dh2:
+                        dh2[name] = rr_collect_store[lga][ward][name]
+
+        if wards:
+            add_lga_reports(reports, local_gov, result, run_state["grid3_coordinates"], rr_collect_coordinates, grid3=False)
+
+    if isinstance(reports, ReportWriter):
+        # The Excel files hold every LGA of the run, so they are exported again from the whole datasets
+        if run_state.get("excel"):
+            for file_name in reports.datasets:
+                export_excel(reports.get_dataset(file_name), file_name, list(run_state["lgas"]), run_state.get("write_only", False))
+    else:
+        patch_reports(reports)
 
-        print("Done...........................................")
-    print("Finish...........................................")
+    run_state["rr_collect"] = rr_collect_store
+    run_state["rr_collect_coordinates"] = np.asarray(rr_collect_coordinates)
+    save_run_state(run_state, state_file)
+    return updated
 
 
-run(adamawa_LGA)
\ No newline at end of file
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run(adamawa_LGA)